@@ -1,23 +1,27 @@
-# STUDENT INFO STORED AS TUPLE- NAME, EMAIL, SECTION
+# STUDENT INFO STORED AS STUDENT- NAME, EMAIL, SECTION, NETID, TEAM
 # EMAIL DATA STORED AS TUPLE- UID, EMAIL, SUBJECT
-# LOG HISTORY STORED AS NESTED DICT WITH EMAIL AND SKIPS AND SWITCHES
+# STUDENTS CARRY THEIR OWN SKIP AND SWITCH COUNTS
 
 # assumptions made
 #   sections are always taught on the same day
-#   there are only two sections
+#   a switch without a section in the subject is into the other section
+#   so it only works when there are exactly two
 
 from datetime import date
 import os
-import imaplib
-import email
-from email.mime.text import MIMEText
 import csv
 import random
 import pickle
-import smtplib
-import ssl
-from socket import gaierror
+import stat
+import tempfile
+import json
 from math import ceil
+import argparse
+import time
+from contextlib import contextmanager, nullcontext, redirect_stdout
+import re
+# imaplib, smtplib, ssl, email, numpy, asyncio, and the thread and process pools are imported
+# by the functions that use them so offline runs never pay for loading them
 
 # directory of current program
 dir_path = os.path.dirname(os.path.abspath(__file__))
@@ -27,70 +31,409 @@ FROM_EMAIL  = "dartmouthecon26"
 FROM_PWD    = "economics26"
 SMTP_SERVER = "imap.gmail.com"
 SMTP_PORT   = 993
+# append only log of every skip and switch request, one json record per line
+REQUEST_JOURNAL = 'request_journal.jsonl'
+# where the journal's first uncounted record starts and the mail queued for review before it
+JOURNAL_CHECKPOINT = 'journal_checkpoint.pickle'
+ROSTER_FIELDS = ['name', 'email', 'section', 'netid', 'team', 'skips', 'switches']
+# optional roster column with the last day whose requests are included in the skips and switches
+# written in the same file as the counts so a crash can never leave one updated without the other
+COUNTED_THROUGH = 'counted_through'
+SEND_EMAIL_SERVER = "smtp.gmail.com"
 SEND_EMAIL_PORT = 465
+SEND_EMAIL_SSL = True
+# number of students to aim for in each breakout room
+ROOM_SIZE = 5
+# number of smtp sessions used to send breakout group emails in parallel
+SEND_EMAIL_SESSIONS = 3
+# seconds between inbox checks in daemon mode when the server can't idle
+DAEMON_POLL_INTERVAL = 60
+# restart idle well before servers and routers give up on a quiet connection
+IDLE_TIMEOUT = 10 * 60
+# a connection that sat unused longer than this is checked with a noop before it is used again
+IMAP_KEEPALIVE = 5 * 60
+# a dropped connection is retried this many times, waiting twice as long each time up to the max
+IMAP_RECONNECT_ATTEMPTS = 5
+IMAP_BACKOFF = 1
+IMAP_BACKOFF_MAX = 60
+# set to 1 or pass --profile to time every stage and count imap and smtp round trips
+PROFILE_ENV = 'AUTOCALL_PROFILE'
+PROFILE_REPORT = 'profile_report.json'
+# sqlite database of every skip and switch built from the request journal for reports
+USAGE_LEDGER = 'usage_ledger.sqlite'
+# a ledger written with a different layout is rebuilt from the journal
+LEDGER_VERSION = 2
+# number of courses processed at once when running from a course config
+COURSE_WORKERS = 4
+# each course's output goes to this file in its folder instead of being mixed together on screen
+COURSE_LOG = 'autocall.log'
+# servers a course uses when its config leaves them out
+# kept apart from the globals since a pool process runs one course after another
+COURSE_DEFAULTS = { 'imap_server': SMTP_SERVER, 'smtp_server': SEND_EMAIL_SERVER, 'smtp_port': SEND_EMAIL_PORT }
+# number of uids to ask for in a single header fetch command
+HEADER_FETCH_CHUNK = 500
+# number of uids to put in a single store, copy, or move command
+UID_BATCH = 500
+FETCH_UID = re.compile(rb'UID (\d+)')
+# what comes before the section in switch, switch 10a, or switch to section 10a once whitespace is removed
+SWITCH_SUBJECT = r'switch(?:to)?(?:section)?'
+# optional json file of classification rules kept next to the roster, the defaults below are used without it
+MAIL_RULES = 'mail_rules.json'
+# answers given to sort_prompt keyed by sender and subject so the same kind of mail is only asked about once
+MAIL_DECISIONS = 'mail_decisions.json'
+# only mail from these domains is read, subject and from patterns are matched against the lowercased
+# subject with whitespace removed and the lowercased from header, body patterns against the first body_lines lines
+# {sections} in a pattern stands for any section name on the roster
+# so switchboard or switching partners is left for a person instead of being taken as a switch
+DEFAULT_MAIL_RULES = {
+    'sender_domains': ['dartmouth.edu'],
+    'body_lines': 5,
+    'rules': [
+        {'field': 'subject', 'pattern': '^skip$', 'type': 'skip'},
+        {'field': 'subject', 'pattern': '^switch(?:to)?(?:section)?(?:{sections})?$', 'type': 'switch'},
+    ],
+}
+MAIL_TYPES = {'delete': 0, 'skip': 1, 'switch': 2}
+# bytes of each message body to fetch when a body rule needs to look at it
+BODY_PREVIEW_BYTES = 1024
+# folder next to the roster holding downloaded unknown mail, oldest read mail is dropped past the size limit
+MESSAGE_CACHE = 'message_cache'
+MESSAGE_CACHE_BYTES = 50 * 1024 * 1024
+# extra imap connections that download unknown mail while earlier mail is being reviewed
+PREFETCH_CONNECTIONS = 2
+# messages asked for per fetch so the first ones to be reviewed arrive quickly
+PREFETCH_BATCH = 5
+# lines of the body shown under the from line when asking about unknown mail
+MESSAGE_PREVIEW_LINES = 10
+
+# numpy is optional and slow to load so it is only imported the first time rooms are assigned
+numpy = None
+numpy_checked = False
+
+def load_numpy():
+    global numpy, numpy_checked
+    if not numpy_checked:
+        numpy_checked = True
+        try:
+            import numpy
+        except ImportError:
+            # assign_rooms sorts plain lists instead
+            numpy = None
+    return numpy
+
+# collects how long each stage of a run takes and what every imap and smtp command cost
+class Profiler:
+    def __init__(self):
+        import threading
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = list()
+        self.commands = dict()
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.stages.append({ 'stage': name, 'seconds': time.perf_counter() - start })
+
+    def record(self, protocol, command, seconds, sent=0, received=0):
+        with self.lock:
+            totals = self.commands.setdefault((protocol, command), { 'count': 0, 'seconds': 0.0, 'bytes_sent': 0, 'bytes_received': 0 })
+            totals['count'] += 1
+            totals['seconds'] += seconds
+            totals['bytes_sent'] += sent
+            totals['bytes_received'] += received
+
+    # counts bytes and times every command on an imap connection
+    def wrap_imap(self, mail):
+        send, read, readline, simple_command = mail.send, mail.read, mail.readline, mail._simple_command
+
+        def counted_send(data):
+            self.record('imap', 'bytes', 0, sent=len(data))
+            return send(data)
+
+        def counted_read(size):
+            data = read(size)
+            self.record('imap', 'bytes', 0, received=len(data))
+            return data
+
+        def counted_readline():
+            line = readline()
+            self.record('imap', 'bytes', 0, received=len(line))
+            return line
+
+        def timed_command(name, *args):
+            # uid commands are only useful broken down by what they do
+            command = name + ' ' + str(args[0]).upper() if name == 'UID' and len(args) > 0 else name
+            start = time.perf_counter()
+            try:
+                return simple_command(name, *args)
+            finally:
+                self.record('imap', command, time.perf_counter() - start)
+
+        mail.send, mail.read, mail.readline, mail._simple_command = counted_send, counted_read, counted_readline, timed_command
+        return mail
+
+    # counts bytes and times every command on an smtp connection
+    def wrap_smtp(self, server):
+        send, putcmd, getreply = server.send, server.putcmd, server.getreply
+        pending = dict()
+
+        def counted_send(data):
+            self.record('smtp', 'bytes', 0, sent=len(data))
+            # message data is sent without a command so time its reply from here
+            pending.setdefault('start', time.perf_counter())
+            return send(data)
+
+        def timed_putcmd(cmd, args=''):
+            pending['command'] = cmd.upper()
+            pending['start'] = time.perf_counter()
+            return putcmd(cmd, args)
+
+        def timed_getreply():
+            code, message = getreply()
+            end = time.perf_counter()
+            command = pending.pop('command', 'DATA END')
+            seconds = end - pending.pop('start', end)
+            self.record('smtp', command, seconds, received=len(message) + 6)
+            return code, message
+
+        server.send, server.putcmd, server.getreply = counted_send, timed_putcmd, timed_getreply
+        return server
+
+    def report(self):
+        commands = list()
+        for (protocol, command), totals in sorted(self.commands.items()):
+            if command != 'bytes':
+                commands.append(dict(protocol=protocol, command=command, **totals))
+        totals = dict()
+        for (protocol, command), counts in self.commands.items():
+            protocol_totals = totals.setdefault(protocol, { 'round_trips': 0, 'seconds': 0.0, 'bytes_sent': 0, 'bytes_received': 0 })
+            if command != 'bytes':
+                protocol_totals['round_trips'] += counts['count']
+            protocol_totals['seconds'] += counts['seconds']
+            protocol_totals['bytes_sent'] += counts['bytes_sent']
+            protocol_totals['bytes_received'] += counts['bytes_received']
+        return { 'started': self.started, 'stages': self.stages, 'totals': totals, 'commands': commands }
+
+    # writes the json report next to the roster and prints a summary table
+    def save(self):
+        report = self.report()
+        with atomic_open(dir_path + '/' + PROFILE_REPORT) as f:
+            json.dump(report, f, indent=2)
+        print()
+        print('%-32s %10s' % ('stage', 'seconds'))
+        for row in report['stages']:
+            print('%-32s %10.3f' % (row['stage'], row['seconds']))
+        print('%-32s %8s %10s %12s %12s' % ('command', 'count', 'seconds', 'bytes sent', 'bytes recv'))
+        for row in report['commands']:
+            print('%-32s %8d %10.3f %12d %12d' % (row['protocol'] + ' ' + row['command'], row['count'], row['seconds'], row['bytes_sent'], row['bytes_received']))
+        for protocol, row in sorted(report['totals'].items()):
+            print('%-32s %8d %10.3f %12d %12d' % (protocol + ' total', row['round_trips'], row['seconds'], row['bytes_sent'], row['bytes_received']))
+        print('Profile written to ' + PROFILE_REPORT)
+
+# only set while profiling so the normal path pays for a single none check
+profiler = None
+
+def start_profiling():
+    global profiler
+    profiler = Profiler()
+    return profiler
+
+def stage(name):
+    if profiler is None:
+        return nullcontext()
+    return profiler.stage(name)
 
 def initialize_imap():
-    mail = imaplib.IMAP4_SSL(SMTP_SERVER)
-    mail.login(FROM_EMAIL, FROM_PWD)
+    import imaplib
+    with stage('imap connect and login'):
+        mail = imaplib.IMAP4_SSL(SMTP_SERVER)
+        if profiler is not None:
+            profiler.wrap_imap(mail)
+        login_imap(mail)
     return mail
 
+# imaplib only asks for the capabilities before login but servers like gmail
+# don't list extensions such as MOVE and IDLE until the client is logged in
+def login_imap(mail):
+    mail.login(FROM_EMAIL, FROM_PWD)
+    result = mail.capability()
+    if result[0] == 'OK':
+        mail.capabilities = tuple(result[1][-1].decode('ascii').upper().split())
+
 def disconnect_imap(mail):
     mail.expunge()
     mail.close()
 
-def get_use_data():
-    num_uses = dict()
+# one logged in connection reused for the whole run with the inbox selected
+# checked with a noop after sitting unused and reconnected with backoff if the server dropped it
+# deleted mail is expunged and the connection logged out when the session ends
+class ImapSession:
+    def __init__(self):
+        self.mail = None
+        self.connected = False
+        self.last_used = 0
+
+    def connect(self):
+        mail = initialize_imap()
+        mail.select('inbox', readonly=False)
+        self.mail = mail
+        self.connected = True
+        self.last_used = time.monotonic()
+
+    # the first connection is only tried once so a missing network is reported right away
+    def reconnect(self):
+        import imaplib
+        self.drop()
+        for attempt in range(IMAP_RECONNECT_ATTEMPTS):
+            try:
+                return self.connect()
+            except (imaplib.IMAP4.abort, OSError):
+                if attempt == IMAP_RECONNECT_ATTEMPTS - 1:
+                    raise
+                delay = min(IMAP_BACKOFF * 2 ** attempt, IMAP_BACKOFF_MAX)
+                print('Could not reconnect to the mail server, trying again in ' + str(delay) + ' seconds')
+                time.sleep(delay)
+
+    # returns a live connection, reconnecting first if needed
+    def get(self):
+        import imaplib
+        if self.mail is None:
+            if self.connected:
+                self.reconnect()
+            else:
+                self.connect()
+        elif time.monotonic() - self.last_used > IMAP_KEEPALIVE:
+            try:
+                self.mail.noop()
+            except (imaplib.IMAP4.abort, OSError):
+                self.reconnect()
+        self.last_used = time.monotonic()
+        return self.mail
+
+    # forgets a connection that broke so the next get makes a new one
+    def drop(self):
+        if self.mail is None:
+            return
+        try:
+            self.mail.shutdown()
+        except OSError:
+            pass
+        self.mail = None
+
+    def close(self):
+        import imaplib
+        if self.mail is None:
+            return
+        try:
+            if self.mail.state == 'SELECTED':
+                disconnect_imap(self.mail)
+            self.mail.logout()
+        except (imaplib.IMAP4.error, OSError):
+            # the connection is already gone so there is nothing to expunge
+            pass
+        self.mail = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+# true if a response is already waiting in imaplib's read buffer or ssl's decrypted data
+# select only sees the socket so it would sleep through a line that arrived with an earlier one
+def buffered_input(mail):
+    import ssl
+    timeout = mail.sock.gettimeout()
+    mail.sock.setblocking(False)
     try:
-        with open(dir_path + '/roster.csv') as csv_file:
-            reader = csv.DictReader(csv_file)
-            for row in reader:
-                skips = 0
-                switches = 0
-                try:
-                    if len(row['email'].strip()) == 0:
-                        raise Exception('An email is empty please check the csv file')
-                    if len(row['skips'].strip()) != 0 and int(row['skips'].strip()) != 0:
-                        skips = int(row['skips'].strip())
-                    if len(row['switches'].strip()) != 0 and int(row['switches'].strip()) != 0:
-                        switches = int(row['switches'].strip())
-                    if skips + switches != 0:
-                        num_uses[row['email'].strip().lower()] = { 'skips': skips, 'switches': switches }
-                except KeyError:
-                    raise Exception('Make sure there are columns named name, email, section, netid, team, skips, and switches')
-    except FileNotFoundError:
-        raise Exception('Could not find course roster. Please place csv called roster.csv within the same folder as this program')
-    return num_uses
+        # fills an empty buffer from the socket without waiting
+        return len(mail.file.peek()) > 0
+    except (BlockingIOError, ssl.SSLWantReadError):
+        return False
+    finally:
+        mail.sock.settimeout(timeout)
 
-def save_uses_to_csv(num_uses, students):
-    with open(dir_path + '/roster.csv', 'w', newline='') as f:
-        fieldnames = ['name', 'email', 'section', 'netid', 'team', 'skips', 'switches']
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        writer.writeheader()
-        for student in students:
-            written = False
-            for email in num_uses:
-                if email == student[1]:
-                    writer.writerow({
-                        'name': student[0],
-                        'email': student[1],
-                        'section': student[2],
-                        'netid': student[3],
-                        'team': student[4],
-                        'skips': num_uses[email]['skips'],
-                        'switches': num_uses[email]['switches']
-                    })
-                    written = True
-                    break
-            if not written:
-                writer.writerow({
-                    'name': student[0],
-                    'email': student[1],
-                    'section': student[2],
-                    'netid': student[3],
-                    'team': student[4],
-                    'skips': '',
-                    'switches': ''
-                })
+# waits in idle until the server reports new mail or the timeout passes
+def idle(mail, timeout):
+    import select
+    tag = mail._new_tag()
+    mail.send(tag + b' IDLE\r\n')
+    if not mail.readline().startswith(b'+'):
+        # refused, the tagged error has already been read so just wait it out
+        time.sleep(timeout)
+        return
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        if not buffered_input(mail) and not select.select([mail.sock], [], [], remaining)[0]:
+            break
+        line = mail.readline()
+        if not line:
+            raise mail.abort('connection closed while idling')
+        if line.rstrip().endswith(b'EXISTS'):
+            break
+    mail.send(b'DONE\r\n')
+    while True:
+        line = mail.readline()
+        if not line:
+            raise mail.abort('connection closed while idling')
+        if line.startswith(tag):
+            return
+
+# writes through a temporary file in the same folder that is renamed over path once complete
+# an interrupted run leaves the old file untouched instead of a truncated one
+@contextmanager
+def atomic_open(path, binary=False):
+    folder, name = os.path.split(path)
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix='.' + name + '.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb' if binary else 'w', newline=None if binary else '') as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        # keep the permissions of the file being replaced instead of the private temp file ones
+        try:
+            os.chmod(temp_path, stat.S_IMODE(os.stat(path).st_mode))
+        except FileNotFoundError:
+            os.chmod(temp_path, 0o644)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+# streams rows from any iterable straight into a csv that is swapped in atomically
+def write_csv(path, rows, header=None):
+    with atomic_open(path) as f:
+        writer = csv.writer(f)
+        if header is not None:
+            writer.writerow(header)
+        writer.writerows(rows)
+
+def save_uses_to_csv(students):
+    # nothing to write if no counter changed since the roster was read
+    if not students.uses_changed():
+        return
+    # students who have never used anything are left blank
+    write_csv(dir_path + '/roster.csv', ((
+        student.name,
+        student.email,
+        student.section,
+        student.netid,
+        student.team,
+        student.skips if student.has_uses() else '',
+        student.switches if student.has_uses() else '',
+        students.counted_through
+    ) for student in students), ROSTER_FIELDS + [COUNTED_THROUGH])
+    students.mark_saved()
+    # the roster we just wrote is already parsed so cache it instead of reparsing next run
+    save_roster_cache(roster_cache_key(), [student.row() for student in students], students.counted_through)
 
 # returns an array with an int representing the type of email, the sender, and the subject respectively
 # 0 represents spam mail sent from outside dartmouth
@@ -99,30 +442,340 @@ def save_uses_to_csv(num_uses, students):
 # 3 represents a mailing sent from dartmouth but not formatted for skip or switch
 #   this can occur when a subject line is formatted incorrectly
 def filter_mail(mail, uid):
+    import email
     _, byte_msg = mail.uid('fetch', uid, '(RFC822)')
     msg = email.message_from_bytes(byte_msg[0][1])
-    # lowercase and remove all whitespace for formatting discrepancies
-    unparsed_subject = msg['subject']
-    email_subject = ''.join(unparsed_subject.lower().split())
-    email_from = msg['from'].lower().strip()
-    
-    if '@dartmouth.edu' not in email_from.lower():
-        return [0, email_from, unparsed_subject] # spam
-    elif email_subject == 'skip':
-        return [1, email_from, unparsed_subject]
-    elif email_subject == 'switch':
-        return [2, email_from, unparsed_subject]
-    else:
-        return [3, email_from, unparsed_subject]
+    return classify_mail(msg['from'], msg['subject'])
 
-def move_email(mail, uid):
-    result = mail.uid('COPY', uid, 'processed')
-    if result[0] == 'OK':
-        mail.uid('STORE', uid , '+FLAGS', '(\\Deleted)')
+# same return value as filter_mail but works from the from and subject headers alone
+def classify_mail(unparsed_from, unparsed_subject, rules=None):
+    unparsed_from = unparsed_from or ''
+    unparsed_subject = unparsed_subject or ''
+    email_from = unparsed_from.lower().strip()
+    rules = rules or get_mail_rules()
+    return [rules.classify(email_from, unparsed_subject), email_from, unparsed_subject]
+
+# lowercase and remove all whitespace for formatting discrepancies
+def normalize_subject(subject):
+    return ''.join(subject.lower().split())
+
+# classification rules compiled once per run plus the decisions remembered from earlier prompts
+# rules are checked in file order and the first match wins
+class MailRules:
+    def __init__(self, config, decisions_path=None, sections=()):
+        # longest first so a section that starts with another section's name still matches whole
+        section_names = '|'.join(re.escape(normalize_subject(section)) for section in sorted(sections, key=len, reverse=True))
+        domains = config.get('sender_domains', [])
+        self.sender = re.compile('|'.join('@' + re.escape(domain.lower()) for domain in domains)) if domains else None
+        self.body_lines = config.get('body_lines', 0)
+        self.header_rules = list()
+        self.body_rules = list()
+        for rule in config.get('rules', []):
+            if rule.get('type') not in MAIL_TYPES or rule.get('field') not in ('from', 'subject', 'body'):
+                raise Exception('Invalid mail rule ' + json.dumps(rule) + '. Rules need a field of from, subject, or body and a type of delete, skip, or switch')
+            pattern = rule['pattern'].replace('{sections}', section_names)
+            compiled = (rule['field'], re.compile(pattern, re.IGNORECASE | re.MULTILINE), MAIL_TYPES[rule['type']])
+            (self.body_rules if rule['field'] == 'body' else self.header_rules).append(compiled)
+        self.decisions_path = decisions_path
+        self.decisions = dict()
+        self.decisions_changed = False
+        if decisions_path is not None:
+            try:
+                with open(decisions_path) as f:
+                    self.decisions = json.load(f)
+            except FileNotFoundError:
+                pass
+
+    def decision_key(self, sender, subject):
+        from email.utils import parseaddr
+        return parseaddr(sender)[1].lower() + '\n' + normalize_subject(subject)
+
+    # returns the mail type for the from and subject headers or 3 if nothing matched
+    def classify(self, email_from, subject):
+        if self.sender is not None and not self.sender.search(email_from):
+            return 0 # spam
+        fields = {'from': email_from, 'subject': normalize_subject(subject)}
+        for field, pattern, mail_type in self.header_rules:
+            if pattern.search(fields[field]):
+                return mail_type
+        return self.decisions.get(self.decision_key(email_from, subject), 3)
+
+    # returns the mail type for the first lines of a body or 3 if nothing matched
+    def classify_body(self, body):
+        text = '\n'.join(body.lower().splitlines()[:self.body_lines])
+        for _, pattern, mail_type in self.body_rules:
+            if pattern.search(text):
+                return mail_type
+        return 3
+
+    # returns the remembered answer for a uid, sender, subject tuple or None if it was never asked about
+    def decided(self, mail_info):
+        return self.decisions.get(self.decision_key(mail_info[1], mail_info[2]))
+
+    def remember(self, mail_info, mail_type):
+        key = self.decision_key(mail_info[1], mail_info[2])
+        if self.decisions.get(key) != mail_type:
+            self.decisions[key] = mail_type
+            self.decisions_changed = True
 
-def sort_prompt(mail_info):
+    def save(self):
+        if self.decisions_path is None or not self.decisions_changed:
+            return
+        with atomic_open(self.decisions_path) as f:
+            json.dump(self.decisions, f, indent=1, sort_keys=True)
+        self.decisions_changed = False
+
+# compiled rules for each course folder so they are only built once per run
+# rebuilt when the roster changes since the switch rule depends on the section names
+mail_rules = dict()
+
+def get_mail_rules():
+    key = roster_cache_key()
+    if mail_rules.get(dir_path, (None,))[0] != key:
+        try:
+            with open(dir_path + '/' + MAIL_RULES) as f:
+                config = json.load(f)
+        except FileNotFoundError:
+            config = DEFAULT_MAIL_RULES
+        rules = MailRules(config, dir_path + '/' + MAIL_DECISIONS, get_sections(get_course_roster()))
+        mail_rules[dir_path] = key, rules
+    return mail_rules[dir_path][1]
+
+# fetches only the from and subject headers for many uids at once instead of one full message per round trip
+# returns a list of tuples with uid, from, and subject in the same order as uids
+# stops at the first chunk the server refuses so the caller can tell how far it got
+def fetch_headers(mail, uids, chunk_size=HEADER_FETCH_CHUNK):
+    from email.parser import BytesHeaderParser
+    header_parser = BytesHeaderParser()
+    headers = dict()
+    for start in range(0, len(uids), chunk_size):
+        chunk = uids[start:start + chunk_size]
+        result, data = mail.uid('fetch', b','.join(chunk), '(BODY.PEEK[HEADER.FIELDS (FROM SUBJECT)])')
+        if result != 'OK':
+            # the rest is read again next run since the checkpoint stops before this chunk
+            print('Could not read the headers of ' + str(len(uids) - start) + ' emails, they will be read on the next run')
+            break
+        for part in data:
+            # each message comes back as a tuple followed by a closing paren on its own
+            if not isinstance(part, tuple):
+                continue
+            match = FETCH_UID.search(part[0])
+            if match is None:
+                continue
+            msg = header_parser.parsebytes(part[1])
+            headers[match.group(1)] = (msg['from'], msg['subject'])
+    return [(uid,) + headers[uid] for uid in uids if uid in headers]
+
+# returns the decoded plain text body of a raw message, or the html body if there is no plain one
+# a message cut off part way through still gives whatever text was there
+def message_text(raw):
+    import email
+    from email import policy
+    msg = email.message_from_bytes(raw, policy=policy.default)
+    part = msg.get_body(preferencelist=('plain', 'html'))
+    if part is None:
+        return ''
+    try:
+        return part.get_content()
+    except (LookupError, ValueError):
+        # unknown charset or broken encoding, show what we can
+        return part.get_payload(decode=True).decode('utf-8', 'replace')
+
+# fetches the start of each message body without marking it read
+# the content headers come along so multipart, base64, and quoted printable mail can be decoded
+# returns a dict of the decoded plain text, or html if there is no plain part, keyed by uid
+def fetch_body_previews(mail, uids, chunk_size=HEADER_FETCH_CHUNK):
+    previews = dict()
+    for start in range(0, len(uids), chunk_size):
+        chunk = uids[start:start + chunk_size]
+        _, data = mail.uid('fetch', b','.join(chunk), '(BODY.PEEK[HEADER.FIELDS (CONTENT-TYPE CONTENT-TRANSFER-ENCODING)] '
+            + 'BODY.PEEK[TEXT]<0.' + str(BODY_PREVIEW_BYTES) + '>)')
+        sections = dict()
+        uid = None
+        for part in data:
+            if not isinstance(part, tuple):
+                continue
+            # the uid is only sent with the first section of each message
+            match = FETCH_UID.search(part[0])
+            if match is not None:
+                uid = match.group(1)
+            if uid is not None:
+                sections.setdefault(uid, dict())[b'HEADER' in part[0]] = part[1]
+        for uid, parts in sections.items():
+            previews[uid] = message_text(parts.get(True, b'\r\n') + parts.get(False, b''))
+    return previews
+
+# compresses uids into an imap sequence set such as 12:40,55,57:60
+def uid_sequence_set(uids):
+    ranges = list()
+    for uid in sorted(set(int(uid) for uid in uids)):
+        if len(ranges) > 0 and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(str(low) if low == high else str(low) + ':' + str(high) for low, high in ranges)
+
+# splits uids into sequence sets small enough for a single command
+def uid_batches(uids):
+    uids = sorted(set(int(uid) for uid in uids))
+    for start in range(0, len(uids), UID_BATCH):
+        yield uid_sequence_set(uids[start:start + UID_BATCH])
+
+def delete_emails(mail, uids):
+    for uid_set in uid_batches(uids):
+        result = mail.uid('STORE', uid_set, '+FLAGS', '(\\Deleted)')
+        if result[0] != 'OK':
+            print('Could not delete emails ' + uid_set + ', they will be left in the inbox')
+
+# moves every uid to the processed folder in as few commands as possible
+# mail is only flagged for deletion once the server confirms the copy
+def move_emails(mail, uids):
+    for uid_set in uid_batches(uids):
+        if 'MOVE' in mail.capabilities:
+            result = mail.uid('MOVE', uid_set, 'processed')
+            if result[0] == 'OK':
+                continue
+        result = mail.uid('COPY', uid_set, 'processed')
+        if result[0] != 'OK':
+            print('Could not move emails ' + uid_set + ', they will be left in the inbox')
+            continue
+        result = mail.uid('STORE', uid_set, '+FLAGS', '(\\Deleted)')
+        if result[0] != 'OK':
+            print('Copied emails ' + uid_set + ' to processed but could not delete them, they will also be left in the inbox')
+
+# raw messages on disk keyed by uidvalidity and uid
+# file modification times keep the least recently used order between runs
+class MessageCache:
+    def __init__(self, path, max_bytes=MESSAGE_CACHE_BYTES):
+        import threading
+        self.path = path
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        entries = sorted((entry.stat().st_mtime_ns, entry.name, entry.stat().st_size) for entry in os.scandir(path) if entry.name.endswith('.eml'))
+        # oldest first so eviction pops from the front
+        self.sizes = { name: size for _, name, size in entries }
+        self.total = sum(self.sizes.values())
+
+    def name(self, uidvalidity, uid):
+        return uidvalidity.decode() + '-' + uid.decode() + '.eml'
+
+    def __contains__(self, key):
+        return self.name(*key) in self.sizes
+
+    def get(self, uidvalidity, uid):
+        name = self.name(uidvalidity, uid)
+        with self.lock:
+            if name not in self.sizes:
+                return None
+            self.sizes[name] = self.sizes.pop(name)
+        try:
+            with open(self.path + '/' + name, 'rb') as f:
+                raw = f.read()
+            os.utime(self.path + '/' + name)
+            return raw
+        except FileNotFoundError:
+            # removed by hand or by another run
+            with self.lock:
+                self.total -= self.sizes.pop(name, 0)
+            return None
+
+    def put(self, uidvalidity, uid, raw):
+        name = self.name(uidvalidity, uid)
+        with atomic_open(self.path + '/' + name, binary=True) as f:
+            f.write(raw)
+        with self.lock:
+            self.total += len(raw) - self.sizes.pop(name, 0)
+            self.sizes[name] = len(raw)
+            while self.total > self.max_bytes and len(self.sizes) > 1:
+                oldest = next(iter(self.sizes))
+                self.total -= self.sizes.pop(oldest)
+                try:
+                    os.remove(self.path + '/' + oldest)
+                except FileNotFoundError:
+                    pass
+
+def get_message_cache():
+    return MessageCache(dir_path + '/' + MESSAGE_CACHE)
+
+# downloads whole messages for the given uids into the cache over one connection
+def cache_messages(mail, uids, uidvalidity, cache):
+    if len(uids) == 0:
+        return
+    _, data = mail.uid('fetch', b','.join(uids), '(BODY.PEEK[])')
+    for part in data:
+        if not isinstance(part, tuple):
+            continue
+        match = FETCH_UID.search(part[0])
+        if match is not None:
+            cache.put(uidvalidity, match.group(1), part[1])
+
+# downloads unknown mail in the background over a few extra connections in review order
+# body waits for a single message so only the first prompt can be held up
+class BodyPrefetcher:
+    def __init__(self, uids, uidvalidity, cache, connections=PREFETCH_CONNECTIONS):
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        self.uidvalidity = uidvalidity
+        self.cache = cache
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.connections = list()
+        self.pending = dict()
+        missing = [uid for uid in uids if (uidvalidity, uid) not in cache]
+        batches = [missing[start:start + PREFETCH_BATCH] for start in range(0, len(missing), PREFETCH_BATCH)]
+        self.pool = ThreadPoolExecutor(max_workers=max(1, min(connections, len(batches))))
+        for batch in batches:
+            future = self.pool.submit(self.fetch, batch)
+            for uid in batch:
+                self.pending[uid] = future
+
+    # each worker thread logs in once and reuses its connection for every batch
+    def fetch(self, batch):
+        mail = getattr(self.local, 'mail', None)
+        if mail is None:
+            mail = initialize_imap()
+            with self.lock:
+                self.connections.append(mail)
+            mail.select('inbox', readonly=True)
+            self.local.mail = mail
+        cache_messages(mail, batch, self.uidvalidity, self.cache)
+
+    # returns the raw message or None if it couldn't be downloaded
+    def body(self, uid):
+        future = self.pending.get(uid)
+        if future is not None:
+            try:
+                future.result()
+            except Exception as e:
+                print('Could not download the message: ' + (str(e) or type(e).__name__))
+        return self.cache.get(self.uidvalidity, uid)
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+        for mail in self.connections:
+            try:
+                mail.logout()
+            except Exception:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+# returns the first lines of the plain text part of a raw message
+def message_preview(raw, lines=MESSAGE_PREVIEW_LINES):
+    text = message_text(raw)
+    kept = [line.rstrip() for line in text.splitlines() if line.strip() != '']
+    return '\n'.join(['    ' + line for line in kept[:lines]] + (['    ...'] if len(kept) > lines else []))
+
+def sort_prompt(mail_info, body=None):
     while True:
         print('From: ' + mail_info[1] + ' with subject: ' + mail_info[2])
+        if body:
+            print(body)
         response = input().lower().strip()
         if (response == 'delete'):
             return 0
@@ -134,50 +787,210 @@ def sort_prompt(mail_info):
             print('Unrecognized command ' + response + '. Please type delete, skip, or switch')
 
 # prompts the user to classify an email of unknown type
+# answers are remembered so mail with the same sender and subject is sorted without asking again
 # returns 0 if classified as spam, 1 if skip, 2 if switch
-def sort_unknowns(mail, skips, switches, unknowns):
-    if len(unknowns) > 0:
+# bodies are downloaded in the background while earlier mail is being reviewed
+# with a session the connection is checked again after the prompts since answering them can take a while
+def sort_unknowns(mail, skips, switches, unknowns, uidvalidity=None, session=None):
+    rules = get_mail_rules()
+    asking = [unknown[0] for unknown in unknowns if rules.decided(unknown) is None]
+    if len(asking) > 0:
         print('The following emails were sent from dartmouth but could not be classified. Please classify each email type by typing delete, skip, or switch')
     
-    for unknown in unknowns:
-        mail_type = sort_prompt(unknown)
-        if mail_type == 0:
-            # spam
-            mail.uid('STORE', unknown[0], '+FLAGS', '\\Deleted')
-        elif mail_type == 1:
-            skips.append(unknown)
+    # closed even if a prompt is interrupted so the extra logins end and queued downloads are dropped
+    with BodyPrefetcher(asking, uidvalidity, get_message_cache()) if uidvalidity is not None and len(asking) > 0 else nullcontext() as prefetcher:
+        spam = list()
+        for unknown in unknowns:
+            mail_type = rules.decided(unknown)
+            if mail_type is None:
+                raw = prefetcher.body(unknown[0]) if prefetcher is not None else None
+                mail_type = sort_prompt(unknown, message_preview(raw) if raw else None)
+                rules.remember(unknown, mail_type)
+            if mail_type == 0:
+                spam.append(unknown[0])
+            elif mail_type == 1:
+                skips.append(unknown)
+            else:
+                switches.append(unknown)
+    rules.save()
+    if session is not None:
+        mail = session.get()
+    delete_emails(mail, spam)
+    return spam
+
+# keeps one logged in smtp session open and reuses it for every message
+# reconnects once if the server drops the session between messages
+class MailSender:
+    # defaults are looked up when the sender is made so the server can be pointed elsewhere
+    def __init__(self, host=None, port=None, use_ssl=None):
+        self.host = host or SEND_EMAIL_SERVER
+        self.port = port or SEND_EMAIL_PORT
+        self.use_ssl = SEND_EMAIL_SSL if use_ssl is None else use_ssl
+        self.server = None
+
+    def connect(self):
+        import smtplib
+        import ssl
+        if self.use_ssl:
+            server = smtplib.SMTP_SSL(self.host, self.port, context=ssl.create_default_context())
         else:
-            switches.append(unknown)
+            server = smtplib.SMTP(self.host, self.port)
+        if profiler is not None:
+            profiler.wrap_smtp(server)
+        try:
+            server.login(FROM_EMAIL, FROM_PWD)
+        except (smtplib.SMTPException, OSError):
+            # not kept so the next message tries a fresh login instead of sending unauthenticated
+            server.close()
+            raise
+        self.server = server
 
-def send_email(recipient_addresses, subject, message):
-    context = ssl.create_default_context()
+    def close(self):
+        import smtplib
+        if self.server is None:
+            return
+        try:
+            self.server.quit()
+        except (smtplib.SMTPException, OSError):
+            # already gone, nothing left to clean up
+            pass
+        self.server = None
 
-    with smtplib.SMTP_SSL("smtp.gmail.com", SEND_EMAIL_PORT, context=context) as server:
+    # returns a dict of the recipients the server refused and the reason
+    def send(self, recipient_addresses, subject, message):
+        import smtplib
+        from email.mime.text import MIMEText
         formatted_msg = MIMEText(message)
         formatted_msg['Subject'] = subject
         formatted_msg['From'] = FROM_EMAIL
         formatted_msg['To'] = ", ".join(recipient_addresses)
-        server.login(FROM_EMAIL, FROM_PWD)
-        server.sendmail(FROM_EMAIL, recipient_addresses, formatted_msg.as_string())
+        for attempt in range(2):
+            if self.server is None:
+                self.connect()
+            try:
+                return self.server.sendmail(FROM_EMAIL, recipient_addresses, formatted_msg.as_string())
+            except smtplib.SMTPRecipientsRefused as e:
+                return e.recipients
+            except (smtplib.SMTPServerDisconnected, ConnectionResetError):
+                self.server = None
+                if attempt > 0:
+                    raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *_):
+        self.close()
+
+def send_email(recipient_addresses, subject, message):
+    with MailSender() as sender:
+        return sender.send(recipient_addresses, subject, message)
+
+# sends each (recipients, subject, message) over a small pool of reused sessions
+# returns a dict of every recipient that could not be mailed and the reason
+def send_emails(messages, sessions=SEND_EMAIL_SESSIONS, **sender_options):
+    import queue
+    import smtplib
+    from concurrent.futures import ThreadPoolExecutor
+    senders = queue.Queue()
+    for _ in range(min(sessions, len(messages))):
+        senders.put(MailSender(**sender_options))
+    failures = dict()
 
-def read_emails(mail):
+    def send(message):
+        sender = senders.get()
+        try:
+            return sender.send(*message)
+        except (smtplib.SMTPException, OSError) as e:
+            # the whole message failed, connecting included, so every recipient missed it
+            # and the other rooms still go out
+            return { recipient: str(e) or type(e).__name__ for recipient in message[0] }
+        finally:
+            senders.put(sender)
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, senders.qsize())) as pool:
+            for refused in pool.map(send, messages):
+                failures.update(refused)
+    finally:
+        while not senders.empty():
+            senders.get().close()
+    return failures
+
+# returns the inbox uidvalidity and the highest uid that has already been classified
+def get_sync_checkpoint():
+    try:
+        with open(dir_path + '/sync_checkpoint.pickle', 'rb') as f:
+            return pickle.load(f)
+    except FileNotFoundError:
+        # never synced, rescan everything
+        return None, 0
+
+def save_sync_checkpoint(checkpoint):
+    with atomic_open(dir_path + '/sync_checkpoint.pickle', binary=True) as f:
+        pickle.dump(checkpoint, f, pickle.HIGHEST_PROTOCOL)
+
+# returns the skips, switches, and the checkpoint to save once they have been cached
+# only mail that arrived after the saved checkpoint is classified
+# without review unknown mail is queued in the journal to be classified on a later run
+# with review the mail already queued, as kept by the request index, is asked about too
+def read_emails(mail, review=True, queued=(), session=None):
+    skips, switches, unknowns, checkpoint = fetch_new_mail(mail)
+    review_unknowns(mail, skips, switches, unknowns, review, checkpoint[0], queued, session)
+    return skips, switches, checkpoint
+
+# classifies new mail and deletes spam without asking anything
+# returns the skips, switches, unknowns, and the checkpoint to save once they have been cached
+def fetch_new_mail(mail):
+    from email.utils import parseaddr
     # select the inbox
     mail.select('inbox', readonly=False)
-    # pull all emails from the inbox
-    _, data = mail.uid('search', None, 'ALL')
+    uidvalidity = mail.response('UIDVALIDITY')[1][0]
+    uidnext = mail.response('UIDNEXT')[1][0]
 
     skips = list()
     switches = list()
     unknowns = list()
 
-    for i in data[0].split():
-        response = filter_mail(mail, i)
-        mail_type = response[0]
+    saved_uidvalidity, last_uid = get_sync_checkpoint()
+    uids = list()
+    if saved_uidvalidity != uidvalidity:
+        # uids from the last run no longer mean anything, rescan the whole inbox
+        last_uid = 0
+    if uidnext is None or int(uidnext) > last_uid + 1:
+        # pull all emails that arrived since the last run
+        _, data = mail.uid('search', None, 'UID ' + str(last_uid + 1) + ':*')
+        # n:* always matches the newest message even if it is older than n
+        uids = sorted((uid for uid in data[0].split() if int(uid) > last_uid), key=int)
+    headers = fetch_headers(mail, uids)
+    # headers come back in uid order, anything from the first missing one on is left for the next run
+    # so the checkpoint never moves past mail that wasn't read
+    for count, header in enumerate(headers):
+        if header[0] != uids[count]:
+            headers = headers[:count]
+            break
+    if len(headers) > 0:
+        last_uid = int(headers[-1][0])
+
+    rules = get_mail_rules()
+    classified = list()
+    for i, email_from, email_subject in headers:
+        response = classify_mail(email_from, email_subject, rules)
+        classified.append([i] + response)
+    # only mail the headers couldn't sort needs its body looked at
+    if len(rules.body_rules) > 0:
+        previews = fetch_body_previews(mail, [response[0] for response in classified if response[1] == 3])
+        for response in classified:
+            if response[0] in previews:
+                response[1] = rules.classify_body(previews[response[0]])
+
+    spam = list()
+    for i, mail_type, email_from, email_subject in classified:
         # throw out mail type we don't need it
-        mail_info = i, email.utils.parseaddr(response[1])[1], response[2] # uid, sender, and subject
+        mail_info = i, parseaddr(email_from)[1], email_subject # uid, sender, and subject
         if mail_type == 0: # spam
-            # delete email
-            mail.uid('STORE', i, '+FLAGS', '\\Deleted')
+            # delete email once everything is classified
+            spam.append(i)
         elif mail_type == 1:
             # skip email
             skips.append(mail_info)
@@ -187,111 +1000,483 @@ def read_emails(mail):
         else:
             # unknown email from dartmouth
             unknowns.append(mail_info)
-    sort_unknowns(mail, skips, switches, unknowns)
-    return skips, switches
+    delete_emails(mail, spam)
+    return skips, switches, unknowns, (uidvalidity, last_uid)
+
+# asks about new and queued unknown mail or just queues the new mail without review
+# queued mail is downloaded into the message cache so it shows up instantly when it is reviewed
+def review_unknowns(mail, skips, switches, unknowns, review=True, uidvalidity=None, queued=(), session=None):
+    today = date.today().isoformat()
+    if review:
+        queued_uids = set(unknown[0] for unknown in queued)
+        unknowns = list(queued) + [unknown for unknown in unknowns if unknown[0] not in queued_uids]
+        deleted = set(sort_unknowns(mail, skips, switches, unknowns, uidvalidity, session))
+        # queued mail that was deleted shouldn't come up for review again
+        append_journal([request_record(unknown, 'deleted', today) for unknown in queued if unknown[0] in deleted])
+    else:
+        append_journal([request_record(unknown, 'unknown', today) for unknown in unknowns])
+        if uidvalidity is not None and len(unknowns) > 0:
+            cache_messages(mail, [unknown[0] for unknown in unknowns], uidvalidity, get_message_cache())
+
+# a single student in the course and how many skips and switches they have used
+class Student:
+    __slots__ = ('name', 'email', 'section', 'netid', 'team', 'skips', 'switches')
+
+    def __init__(self, name, email, section, netid, team, skips=0, switches=0):
+        self.name = name
+        self.email = email
+        self.section = section
+        self.netid = netid
+        self.team = team
+        self.skips = skips
+        self.switches = switches
+
+    # false until the student has used a skip or a switch
+    def has_uses(self):
+        return self.skips + self.switches != 0
+
+    def row(self):
+        return (self.name, self.email, self.section, self.netid, self.team, self.skips, self.switches)
 
-# returns a list of all students in the course with name, email, and section
+# the course roster with indexes so students can be looked up in constant time
+class Roster:
+    def __init__(self, students, counted_through=''):
+        self.students = students
+        self.counted_through = counted_through
+        self.by_email = dict()
+        self.by_netid = dict()
+        self.by_section = dict()
+        for student in students:
+            self.by_email[student.email] = student
+            self.by_netid[student.netid] = student
+            self.by_section.setdefault(student.section, list()).append(student)
+        self.mark_saved()
+
+    # remembers the counters as they are on disk
+    def mark_saved(self):
+        self.saved_uses = [(student.skips, student.switches) for student in self.students]
+        self.saved_counted_through = self.counted_through
+
+    def uses_changed(self):
+        if self.counted_through != self.saved_counted_through:
+            return True
+        return any((student.skips, student.switches) != saved for student, saved in zip(self.students, self.saved_uses))
+
+    def __iter__(self):
+        return iter(self.students)
+
+    def __len__(self):
+        return len(self.students)
+
+    def section(self, section):
+        return self.by_section.get(section, list())
+
+    # returns the students in the roster who sent at least one of the requests
+    def senders(self, requests):
+        found = dict()
+        for request in requests:
+            student = self.by_email.get(request[1])
+            if student is not None:
+                found[student.email] = student
+        return list(found.values())
+
+    # returns the section each switching student is moving into keyed by email
+    # a plain switch means the other section so it only works when there are exactly two
+    def switch_targets(self, switches):
+        targets = dict()
+        for switcher in switches:
+            student = self.by_email.get(switcher[1])
+            if student is None:
+                continue
+            target = self.switch_target(student, switcher[2])
+            if target is not None:
+                targets[student.email] = target
+            elif student.email not in targets:
+                print(student.name + ' asked to switch but it is not clear which section they want. Subject: ' + switcher[2])
+        return targets
+
+    # returns the section a switch subject asks for or None if it isn't clear
+    # each section name is matched whole like the switch rule does so switch section1 finds section1
+    def switch_target(self, student, subject):
+        subject = normalize_subject(subject)
+        others = [section for section in self.by_section if section != student.section]
+        for section in sorted(others, key=len, reverse=True):
+            if re.fullmatch(SWITCH_SUBJECT + re.escape(normalize_subject(section)), subject):
+                return section
+        if re.fullmatch(SWITCH_SUBJECT, subject) and len(others) == 1:
+            return others[0]
+        return None
+
+# reads and validates every column of roster.csv in one pass
+# returns a list of tuples that can be turned into students and the day the counts go up to
+def parse_roster(path):
+    rows = list()
+    counted_through = ''
+    with open(path) as csv_file:
+        reader = csv.DictReader(csv_file)
+        for row in reader:
+            try:
+                name = row['name'].strip()
+                student_email = row['email'].strip().lower()
+                section = row['section'].strip().lower()
+                netid = row['netid'].strip()
+                team = row['team'].strip()
+                skips = row['skips'].strip()
+                switches = row['switches'].strip()
+            except (KeyError, AttributeError):
+                # a short row leaves the missing columns as None
+                raise Exception('Make sure there are columns named name, email, section, netid, team, skips, and switches')
+            if len(name) == 0:
+                raise Exception('A name is empty please check the csv file')
+            if len(student_email) == 0:
+                raise Exception('An email is empty please check the csv file')
+            if len(section) == 0:
+                raise Exception('A section is empty please check the csv file')
+            if len(netid) == 0:
+                raise Exception('A netid is empty please check the csv file')
+            if len(team) == 0:
+                raise Exception('A team is empty please check the csv file')
+            rows.append((name, student_email, section, netid, team, int(skips) if skips else 0, int(switches) if switches else 0))
+            counted_through = max(counted_through, (row.get(COUNTED_THROUGH) or '').strip())
+    return rows, counted_through
+
+# roster.csv is only reparsed when its modification time or size changes
+def roster_cache_key():
+    try:
+        roster_stat = os.stat(dir_path + '/roster.csv')
+    except FileNotFoundError:
+        raise Exception('Could not find course roster. Please place csv called roster.csv within the same folder as this program')
+    return roster_stat.st_mtime_ns, roster_stat.st_size
+
+def load_roster_cache(key):
+    try:
+        with open(dir_path + '/roster_cache.pickle', 'rb') as f:
+            cached_key, rows, counted_through = pickle.load(f)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError, ValueError):
+        return None
+    if cached_key != key:
+        return None
+    return rows, counted_through
+
+def save_roster_cache(key, rows, counted_through):
+    with atomic_open(dir_path + '/roster_cache.pickle', binary=True) as f:
+        pickle.dump((key, rows, counted_through), f, pickle.HIGHEST_PROTOCOL)
+
+# returns every student in the course along with how many skips and switches they have used
 def get_course_roster():
-    students = list()
+    key = roster_cache_key()
+    cached = load_roster_cache(key)
+    if cached is None:
+        cached = parse_roster(dir_path + '/roster.csv')
+        save_roster_cache(key, *cached)
+    rows, counted_through = cached
+    return Roster([Student(*row) for row in rows], counted_through)
+
+# yields every complete record in the request journal from the given byte offset on
+# along with where the record starts and ends so the next read can pick up after it
+# a record cut off by a crash mid write is ignored
+def read_journal(offset=0):
     try:
-        with open(dir_path + '/roster.csv') as csv_file:
-            reader = csv.DictReader(csv_file)
-            for row in reader:
+        with open(dir_path + '/' + REQUEST_JOURNAL, 'rb') as f:
+            if f.seek(0, os.SEEK_END) < offset:
+                # the journal was replaced so start over
+                offset = 0
+            f.seek(offset)
+            for line in f:
+                if not line.endswith(b'\n'):
+                    return
+                start = offset
+                offset += len(line)
                 try:
-                    if len(row['name'].strip()) == 0:
-                        raise Exception('A name is empty please check the csv file')
-                    if len(row['email'].strip()) == 0:
-                        raise Exception('An email is empty please check the csv file')
-                    if len(row['section'].strip()) == 0:
-                        raise Exception('A section is empty please check the csv file')
-                    if len(row['netid'].strip()) == 0:
-                        raise Exception('A netid is empty please check the csv file')
-                    if len(row['team'].strip()) == 0:
-                        raise Exception('A team is empty please check the csv file')
-                except KeyError:
-                    raise Exception('Make sure there are columns named name, email, section, netid, team')
-                students.append((row['name'].strip(), row['email'].strip().lower(), row['section'].strip().lower(), row['netid'], row['team']))
+                    yield start, offset, json.loads(line)
+                except ValueError:
+                    continue
     except FileNotFoundError:
-        raise Exception('Could not find course roster. Please place csv called roster.csv within the same folder as this program')
-    return students
+        # nothing has been journaled yet
+        return
 
-# returns a list of cached switches
-# this is needed because if someone from a later section switches into an earlier section
-# we need to make sure that they don't get added to the later section
-def get_request_cache(num_uses, students, skips, switches):
-    try: 
-        with open(dir_path + '/request_cache.pickle', 'rb') as f:
-            skip_cache, switch_cache, cache_date = pickle.load(f)
-            if date.today() == cache_date:
-                return skip_cache, switch_cache
-            else:
-                save_use_data(num_uses, students, skip_cache, switch_cache)
-        os.remove('request_cache.pickle')
-        return list(), list()
+# returns the offset to start reading the journal from and the mail queued for review before it
+def get_journal_checkpoint():
+    try:
+        with open(dir_path + '/' + JOURNAL_CHECKPOINT, 'rb') as f:
+            offset, unknowns = pickle.load(f)
     except FileNotFoundError:
-        # don't have any saved logs
-        return list(), list()
+        # never folded, read the whole journal
+        return 0, dict()
+    try:
+        size = os.path.getsize(dir_path + '/' + REQUEST_JOURNAL)
+    except FileNotFoundError:
+        size = 0
+    if size < offset:
+        # the journal was replaced so the queue saved with the offset means nothing
+        return 0, dict()
+    return offset, unknowns
+
+def save_journal_checkpoint(checkpoint):
+    with atomic_open(dir_path + '/' + JOURNAL_CHECKPOINT, binary=True) as f:
+        pickle.dump(checkpoint, f, pickle.HIGHEST_PROTOCOL)
 
-def save_request_cache(skips, switches):        # Pickle the 'data' dictionary using the highest protocol available.
-    if len(skips) == 0 and len(switches) == 0:
+# appends records to the request journal and waits for them to reach the disk
+def append_journal(records):
+    if len(records) == 0:
         return
-    with open(dir_path + '/request_cache.pickle', 'wb') as f:
-        pickle.dump((skips, switches, date.today()), f, pickle.HIGHEST_PROTOCOL)
-        
-def save_use_data(num_uses, students, skips, switches):
-    # move the skips from our section
-    for student in students:
-        for skipper in skips:
-            if skipper[1] == student[1]:
-                try: 
-                    num_uses[student[1]]['skips'] += 1
-                except KeyError:
-                    # no logs for this student yet
-                    num_uses[student[1]] = { 'skips': 1, 'switches': 0 }
-                break
-    # move the switches from the other section
-    for student in students:
-        for switcher in switches:
-            if switcher[1] == student[1]:
-                try:
-                    num_uses[student[1]]['switches'] += 1
-                except KeyError:
-                    # no logs for this student yet
-                    num_uses[student[1]] = { 'skips': 0, 'switches': 1 }
-                break
-    save_uses_to_csv(num_uses, students)
+    lines = b''.join(json.dumps(record).encode() + b'\n' for record in records)
+    with open(dir_path + '/' + REQUEST_JOURNAL, 'ab+') as f:
+        # finish off a line left incomplete by a crash so it can't swallow our first record
+        if f.seek(0, os.SEEK_END) > 0:
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b'\n':
+                lines = b'\n' + lines
+        f.write(lines)
+        f.flush()
+        os.fsync(f.fileno())
+
+def request_record(request, kind, day):
+    uid = request[0].decode() if isinstance(request[0], bytes) else str(request[0])
+    return { 'date': day, 'kind': kind, 'uid': uid, 'sender': request[1], 'subject': request[2] }
+
+# every skip and switch request keyed by day, kind, and sender
+# a student who sends the same request several times has one request that remembers every uid
+# so the duplicates are still moved but the student is only counted once
+# it also keeps the queue of mail waiting to be classified by hand and the last folded day
+# so a single pass over the journal gives everything a run needs
+class RequestIndex:
+    def __init__(self, offset=0, unknowns=None):
+        self.requests = dict()
+        self.seen = set()
+        self.unknowns = dict(unknowns or dict())
+        self.folded = ''
+        # where the next update starts reading the journal
+        self.offset = offset
+
+    # adds one journal record, returns true if it was a request that wasn't indexed yet
+    def add_record(self, record):
+        kind = record['kind']
+        if kind == 'fold':
+            self.folded = max(self.folded, record['date'])
+            return False
+        if kind == 'unknown':
+            self.unknowns[record['uid']] = record['uid'].encode(), record['sender'], record['subject']
+            return False
+        # any later classification of the same mail takes it out of the queue
+        self.unknowns.pop(record['uid'], None)
+        if kind not in ('skip', 'switch'):
+            return False
+        return self.add((record['uid'].encode(), record['sender'], record['subject']), kind, record['date'])
+
+    # reads whatever was journaled since the last update and returns how many new requests it held
+    def update(self):
+        added = 0
+        for _, end, record in read_journal(self.offset):
+            added += self.add_record(record)
+            self.offset = end
+        return added
+
+    # returns the queued mail that still needs to be classified by hand
+    def queued(self):
+        return list(self.unknowns.values())
+
+    # returns false if the message was already indexed for that day
+    def add(self, request, kind, day):
+        uid, sender, subject = request
+        if (day, uid) in self.seen:
+            return False
+        self.seen.add((day, uid))
+        self.requests.setdefault((day, kind), dict()).setdefault(sender, dict())[uid] = subject
+        return True
+
+    # adds every message and returns the ones that weren't indexed yet
+    def merge(self, requests, kind, day):
+        return [request for request in requests if self.add(request, kind, day)]
+
+    def days(self):
+        return sorted(set(day for day, _ in self.requests))
+
+    # returns the uids and subjects of every message behind each sender's request
+    def senders(self, kind, day):
+        return self.requests.get((day, kind), dict())
+
+    # returns one uid, sender, subject tuple per sender, the newest message stands for the rest
+    def latest(self, kind, day):
+        latest = list()
+        for sender, messages in self.senders(kind, day).items():
+            uid = max(messages, key=int)
+            latest.append((uid, sender, messages[uid]))
+        return latest
+
+# returns every journaled skip and switch in a request index
+# today's requests are needed because if someone from a later section switches into an earlier section
+# we need to make sure that they don't get added to the later section
+# requests from earlier days that haven't been counted yet are added to the roster use data
+# the roster records the last counted day along with the counts so a crash can't count a day twice
+# reading starts where today's records began on the last run since everything before was counted then
+# so each run only reads about a day of the journal however long the semester has been
+def get_request_cache(students):
+    today = date.today().isoformat()
+    offset, unknowns = get_journal_checkpoint()
+    index = RequestIndex(offset, unknowns)
+    checkpoint = None
+    for start, end, record in read_journal(offset):
+        if checkpoint is None and record['date'] >= today:
+            checkpoint = start, dict(index.unknowns)
+        index.add_record(record)
+        index.offset = end
+    if checkpoint is None:
+        checkpoint = index.offset, dict(index.unknowns)
+
+    folded = max(students.counted_through, index.folded)
+    earlier = [day for day in index.days() if day > folded and day < today]
+    if len(earlier) > 0:
+        # each day counts once per student
+        for day in earlier:
+            count_uses(students, index.latest('skip', day), index.latest('switch', day))
+        students.counted_through = max(earlier)
+        save_uses_to_csv(students)
+        # also mark the days in the journal in case the roster is replaced by hand
+        append_journal([{ 'date': max(earlier), 'kind': 'fold' }])
+    # only moved on once the earlier days are safely in the roster
+    if checkpoint[0] > offset:
+        save_journal_checkpoint(checkpoint)
+    return index
+
+# journals requests classified today, only new requests should be passed in
+def save_request_cache(skips, switches):
+    today = date.today().isoformat()
+    records = [request_record(skip, 'skip', today) for skip in skips]
+    records += [request_record(switch, 'switch', today) for switch in switches]
+    append_journal(records)
+
+def count_uses(students, skips, switches):
+    # each student is only counted once no matter how many requests they sent
+    for student in students.senders(skips):
+        student.skips += 1
+    # a switch only counts if we could tell which section it was into
+    targets = students.switch_targets(switches)
+    for student in students.senders(switches):
+        if student.email in targets:
+            student.switches += 1
+
+# opens the usage ledger and adds any journal records written since it was last updated
+# usage has one row per roster student, day, and kind so repeated requests on a day count once
+# like count_uses a switch takes its target from the newest message and only counts if the target is clear
+# the used view holds just the rows that count, which is what the reports read
+# messages keeps the uid of every request behind those rows, including mail from outside the roster
+# the section and target are looked up in the roster when a request is first added
+def update_ledger(students):
+    import sqlite3
+    db = sqlite3.connect(dir_path + '/' + USAGE_LEDGER)
+    db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)')
+    version = db.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+    if version is None or version[0] != LEDGER_VERSION:
+        db.executescript('''
+            DROP VIEW IF EXISTS used;
+            DROP TABLE IF EXISTS usage;
+            DROP TABLE IF EXISTS messages;
+            DELETE FROM meta;
+        ''')
+    db.executescript('''
+        CREATE TABLE IF NOT EXISTS usage (day TEXT, kind TEXT, email TEXT, name TEXT, netid TEXT,
+            section TEXT, target TEXT, latest_uid INTEGER, messages INTEGER, PRIMARY KEY (day, kind, email))
+        ;
+        CREATE INDEX IF NOT EXISTS usage_email ON usage (email, day)
+        ;
+        CREATE INDEX IF NOT EXISTS usage_section ON usage (section, day)
+        ;
+        CREATE VIEW IF NOT EXISTS used AS SELECT * FROM usage WHERE kind = 'skip' OR target IS NOT NULL
+        ;
+        CREATE TABLE IF NOT EXISTS messages (day TEXT, kind TEXT, uid TEXT, email TEXT, subject TEXT,
+            PRIMARY KEY (day, kind, uid))
+    ''')
+    db.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (LEDGER_VERSION,))
+    row = db.execute("SELECT value FROM meta WHERE key = 'journal_offset'").fetchone()
+    offset = row[0] if row else 0
+    try:
+        with open(dir_path + '/' + REQUEST_JOURNAL, 'rb') as f:
+            if f.seek(0, os.SEEK_END) < offset:
+                # the journal was replaced so start over
+                db.execute('DELETE FROM usage')
+                db.execute('DELETE FROM messages')
+                offset = 0
+            f.seek(offset)
+            data = f.read()
+    except FileNotFoundError:
+        data = b''
+    # a torn last line is picked up once it has been finished
+    data = data[:data.rfind(b'\n') + 1]
+
+    with db:
+        for line in data.splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get('kind') not in ('skip', 'switch'):
+                continue
+            added = db.execute('INSERT OR IGNORE INTO messages VALUES (?, ?, ?, ?, ?)',
+                (record['date'], record['kind'], record['uid'], record['sender'], record['subject'])).rowcount
+            student = students.by_email.get(record['sender'])
+            if not added or student is None:
+                continue
+            target = students.switch_target(student, record['subject']) if record['kind'] == 'switch' else None
+            db.execute('''INSERT INTO usage VALUES (?, ?, ?, ?, ?, ?, ?, ?, 1)
+                ON CONFLICT (day, kind, email) DO UPDATE SET messages = messages + 1,
+                    target = CASE WHEN excluded.latest_uid > latest_uid THEN excluded.target ELSE target END,
+                    latest_uid = max(latest_uid, excluded.latest_uid)''',
+                (record['date'], record['kind'], record['sender'], student.name, student.netid, student.section, target, int(record['uid'])))
+        db.execute("INSERT OR REPLACE INTO meta VALUES ('journal_offset', ?)", (offset + len(data),))
+    return db
+
+# column names and query for each report, skips and switches count days not messages
+LEDGER_REPORTS = {
+    'students': (('name', 'net id', 'section', 'skips', 'switches', 'last used'), '''
+        SELECT name, netid, section, sum(kind = 'skip'), sum(kind = 'switch'), max(day)
+        FROM used GROUP BY email ORDER BY section, name'''),
+    'days': (('day', 'section', 'skips', 'switches'), '''
+        SELECT day, section, sum(kind = 'skip'), sum(kind = 'switch')
+        FROM used GROUP BY day, section ORDER BY day, section'''),
+    'weeks': (('week', 'section', 'skips', 'switches'), '''
+        SELECT strftime('%Y-%W', day), section, sum(kind = 'skip'), sum(kind = 'switch')
+        FROM used GROUP BY 1, section ORDER BY 1, section'''),
+    'sections': (('section', 'students', 'skips', 'switches', 'switched in'), '''
+        SELECT section, count(DISTINCT email), sum(kind = 'skip'), sum(kind = 'switch'),
+            (SELECT count(*) FROM used AS moved WHERE moved.target = used.section)
+        FROM used GROUP BY section ORDER BY section'''),
+}
+# every request a student sent, switches without a clear section are shown but not counted
+STUDENT_REPORT = (('day', 'request', 'into section', 'emails', 'counted'), '''
+    SELECT day, kind, coalesce(target, ''), messages, CASE WHEN kind = 'skip' OR target IS NOT NULL THEN 'yes' ELSE 'no' END
+    FROM usage WHERE email = ? OR lower(netid) = ? ORDER BY day, kind''')
+
+def print_table(header, rows):
+    rows = [[str(value) for value in row] for row in rows]
+    widths = [max([len(header[column])] + [len(row[column]) for row in rows]) for column in range(len(header))]
+    for row in [header] + rows:
+        print('  '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip())
 
 # returns a new roster without the students who have used their skips
-def apply_skips(roster, skips, num_uses, section):
+def apply_skips(roster, skips, section):
     new_roster = []
-    # not efficient but doesn't matter for our use case
+    # a student only counts once no matter how many skips they sent
+    skippers = set(skip[1] for skip in skips)
     for student in roster:
         # if the student isn't in our section we don't care, add to roster and continue
         # we'll process/filter them in apply_switches
-        if student[2] != section:
+        if student.section != section:
             new_roster.append(student)
             continue
 
         skipped = False
-        for skip in skips:
-            # if the student doesn't match the current step don't process the skip
-            if student[1] != skip[1]:
-                continue
-
+        if student.email in skippers:
             # make sure that student hasn't exhausted skips
-            try:
-                num_uses[student[1]]['skips']
-                if num_uses[student[1]]['skips'] >= 5:
-                    print(student[0] + ' attempted to use a skip but they have used all 5')
-                else:
-                    print(student[0] + ' has now used ' + str(num_uses[student[1]]['skips'] + 1) + ' skips')
-                    skipped = True
-            except KeyError:
+            if not student.has_uses():
                 # this student hasn't used any skips or switches yet
-                print(student[0] + ' has now used 1 skip.')
+                print(student.name + ' has now used 1 skip.')
+                skipped = True
+            elif student.skips >= 5:
+                print(student.name + ' attempted to use a skip but they have used all 5')
+            else:
+                print(student.name + ' has now used ' + str(student.skips + 1) + ' skips')
                 skipped = True
-            # break so we don't process multiple skips for the same student
-            break
 
         if not skipped:
             new_roster.append(student)        
@@ -301,49 +1486,45 @@ def apply_skips(roster, skips, num_uses, section):
 def get_sections(roster):
     sections = set()
     for student in roster:
-        sections.add(student[2])
+        sections.add(student.section)
     return sections
 
+# returns a list of the selected sections
 def prompt_sections(sections):
     while True:
-        prompt = 'Please type "both" or select one section by typing its name:'
+        prompt = 'Please type "all" or select one section by typing its name:'
         for section in sorted(sections):
             prompt += ' ' + section
         print(prompt)
         selected_section = input().lower().strip()
 
-        if selected_section == 'both':
-            return tuple(sorted(sections))
+        # both is kept for anyone used to the two section prompt
+        if selected_section == 'all' or selected_section == 'both':
+            return sorted(sections)
         
         if selected_section in sections:
             print('Section ' + selected_section + ' selected')
-            return selected_section, False
+            return [selected_section]
 
-# ASSUMES THERE'S ONLY TWO SECTIONS, ONLY PART OF CODE THAT MAKES THIS ASSUMPTION
 # filters all of the students who should be in our section
 # this is students from our section who have not requested switches
-# also students from another section who have requested a switch
-def apply_switches(roster, switches, num_uses, section):
+# also students from other sections who have requested a switch into ours
+# targets maps the email of each switching student to the section they are moving into
+def apply_switches(roster, targets, section):
     new_roster = []
     for student in roster:
-        switched = False
-        for switcher in switches:
-            # continue, switcher doesn't match
-            if student[1] != switcher[1]:
-                continue
-            # if the student is in our section and switching, mark them and break
-            switched = True
-            if student[2] == section:
-                break
-            try:
-                print(student[0] + ' has now switched ' + str(num_uses[student[1]]['switches'] + 1) + ' times')
-            except KeyError: # this occurs if the student hasn't switched or skipped
-                print(student[0] + ' has now switched 1 time')
-            break
-        if (student[2] == section and not switched) or (student[2] != section and switched):
+        target = targets.get(student.email)
+        switched = target is not None
+        # only report the students switching into our section
+        if target == section:
+            if student.has_uses():
+                print(student.name + ' has now switched ' + str(student.switches + 1) + ' times')
+            else: # this occurs if the student hasn't switched or skipped
+                print(student.name + ' has now switched 1 time')
+        if (student.section == section and not switched) or target == section:
             new_roster.append(student)
     return new_roster
-        
+
 def prompt_action():
     print()
     print('The cold call list has been downloaded.')
@@ -360,179 +1541,459 @@ def prompt_action():
             print('Unrecognized command. Valid commands are save, reset, return, and exit.')
 
 def write_list(call_list, section):
-    with open(dir_path + '/call_list_' + section + '.csv', 'w', newline='') as f:
-        fieldnames = ['name']
-        writer = csv.DictWriter(f, fieldnames=fieldnames)
-        for student in call_list:
-            writer.writerow({'name': student[0]})
+    write_csv(dir_path + '/call_list_' + section + '.csv', ((student.name,) for student in call_list))
 
-def move_processed_emails(mail, students, skips, switches, section):
+# returns the uids of every message behind the requests that were used for our section
+def processed_uids(students, index, targets, section, day):
+    processed = list()
     # move the skips from our section
-    for skipper in skips:
-        for student in students:
-            if skipper[1] == student[1] and student[2] == section:
-                move_email(mail, skipper[0])
-                break
-    # move the switches from the other section
-    for switcher in switches:
-        for student in students:
-            if switcher[1] == student[1] and student[2] != section:
-                move_email(mail, switcher[0])
-                break
-
-def combine_cache(request, request_cache):
-    combined = set()
-    combined.update(request)
-    combined.update(request_cache)
-    return combined
+    for sender, messages in index.senders('skip', day).items():
+        student = students.by_email.get(sender)
+        if student is not None and student.section == section:
+            processed += messages
+    # move the switches into our section
+    for sender, messages in index.senders('switch', day).items():
+        if targets.get(sender) == section:
+            processed += messages
+    return processed
 
-def create_zoom_groups(call_list, students, section):
-    # make teams where there are 5 people who did the readings
-    section_students = list(filter(lambda student: student[2] == section, students))
+def move_processed_emails(mail, students, index, section, day):
+    targets = students.switch_targets(index.latest('switch', day))
+    move_emails(mail, processed_uids(students, index, targets, section, day))
 
-    num_teams = ceil(len(section_students)/5) # aim for 5 student large groups
+# returns the rooms for a section as lists of students
+# active students are dealt out in team order so teammates end up in different rooms
+# students who skipped fill in after them, the room order is reshuffled every round
+# passing a seed makes the assignment reproducible
+def assign_rooms(call_list, section_students, seed=None):
+    numpy = load_numpy()
+    active_students = set(call_list)
+    inactive = [student for student in section_students if student not in active_students] # in the section but used a skip
+    students = call_list + inactive
+    # aim for 5 student large groups, with at least one room for anyone switching into an empty section
+    num_rooms = max(ceil(len(section_students) / ROOM_SIZE), 1 if len(students) > 0 else 0)
+    rooms = [[] for _ in range(num_rooms)]
+    if num_rooms == 0:
+        return rooms
 
-    order = list(range(num_teams))
-    random.shuffle(order)
-    
-    rooms = [[] for _ in range(num_teams)]
-    
-    active_students = sorted(call_list, key=lambda student: int(student[4]))
+    # numpy only sorts the teams, both sorts are stable so the order is the same either way
+    # and the rooms always come from the same generator so a seed gives the same rooms with or without numpy
+    if numpy is not None:
+        teams = numpy.fromiter((int(student.team) for student in call_list), dtype=numpy.int64, count=len(call_list))
+        order = numpy.argsort(teams, kind='stable').tolist()
+    else:
+        order = sorted(range(len(call_list)), key=lambda index: int(call_list[index].team))
+    order += range(len(call_list), len(students))
+    rng = random.Random(seed)
+    room_order = list(range(num_rooms))
+    for position, index in enumerate(order):
+        if position % num_rooms == 0:
+            rng.shuffle(room_order)
+        rooms[room_order[position % num_rooms]].append(students[index])
+    return rooms
 
-    room_assignment = 0
-    for active_student in active_students:
-        if room_assignment % len(rooms) == 0:
-            room_assignment = room_assignment % len(rooms)
-            random.shuffle(order)
-        # zoom uses net ids for emails so create dartmouth email through net id
-        rooms[order[room_assignment]].append(active_student[3] + '@dartmouth.edu')
-        room_assignment += 1
+def create_zoom_groups(call_list, students, section, seed=None):
+    # zoom uses net ids for emails so create dartmouth email through net id
+    rooms = [[student.netid + '@dartmouth.edu' for student in room] for room in assign_rooms(call_list, students.section(section), seed)]
 
-    active_students = set(call_list)
-    
-    for student in section_students:
-        if student not in active_students: # in the section but used a skip
-            if room_assignment % len(rooms) == 0:
-                room_assignment = room_assignment % len(rooms)
-                random.shuffle(order)
-            rooms[order[room_assignment]].append(student[3] + '@dartmouth.edu')
-            room_assignment += 1
-
-    with open('rooms-' + section + '.csv', 'w') as f:
-        writer = csv.writer(f)
-        writer.writerow(('Pre-assign Room Name', 'Email Address'))
-        for idx, room in enumerate(rooms):
-            for netid_email in room:
-                writer.writerow(('room' + str(idx+1), netid_email))
+    write_csv(dir_path + '/rooms-' + section + '.csv',
+        (('room' + str(idx+1), netid_email) for idx, room in enumerate(rooms) for netid_email in room),
+        ('Pre-assign Room Name', 'Email Address'))
 
     print("The group file has been generated. It's named rooms-" + section + ".csv")
         
 
-# creates breakout groups and emails each student their group
-def create_breakout_groups(call_list, students, section):
-    # make teams where there are 5 people who did the readings
-    section_students = list(filter(lambda student: student[2] == section, students))
+def prompt_email():
+    return input('Would you like to email the groups out? Press enter to send or "no" to not send.\n').strip().lower() != 'no'
 
-    num_teams = ceil(len(section_students)/5) # aim for 5 student large groups
-
-    order = list(range(num_teams))
-    random.shuffle(order)
-    
-    rooms = [[] for _ in range(num_teams)]
-    
-    active_students = sorted(call_list, key=lambda student: int(student[4]))
-
-    room_assignment = 0
-    for active_student in active_students:
-        if room_assignment % len(rooms) == 0:
-            room_assignment = room_assignment % len(rooms)
-            random.shuffle(order)
-        # zoom uses net ids for emails so create dartmouth email through net id
-        rooms[order[room_assignment]].append(active_student)
-        room_assignment += 1
+# creates breakout groups and emails each student their group
+# should_email skips the prompt when it is already known whether to send the groups
+def create_breakout_groups(call_list, students, section, should_email=None, seed=None):
+    rooms = assign_rooms(call_list, students.section(section), seed)
 
-    active_students = set(call_list)
-    
-    for student in section_students:
-        if student not in active_students: # in the section but used a skip
-            if room_assignment % len(rooms) == 0:
-                room_assignment = room_assignment % len(rooms)
-                random.shuffle(order)
-            rooms[order[room_assignment]].append(student)
-            room_assignment += 1
-#                    'name': student[0],
-                    # 'email': student[1],
-                    # 'section': student[2],
-                    # 'netid': student[3],
-                    # 'team': student[4],
-    with open('groups-' + section + '.csv', 'w') as f:
-        writer = csv.writer(f)
-        writer.writerow(('Group Name', 'Name', 'Net ID', 'Email'))
-        for idx, room in enumerate(rooms):
-            for student in room:
-                writer.writerow(('room' + str(idx+1), student[0], student[3], student[1]))
+    write_csv(dir_path + '/groups-' + section + '.csv',
+        (('room' + str(idx+1), student.name, student.netid, student.email) for idx, room in enumerate(rooms) for student in room),
+        ('Group Name', 'Name', 'Net ID', 'Email'))
 
     print("The group file has been generated. It's named groups-" + section + ".csv")
     
-    should_email = input('Would you like to email the groups out? Press enter to send or "no" to not send.\n').strip().lower() != 'no'
+    if should_email is None:
+        should_email = prompt_email()
     if should_email:
         print("Sending breakout group emails.")
+        messages = list()
         for idx, room in enumerate(rooms):
             breakout_message = "Your breakout group members for the next class on or after {} are:".format(str(date.today()))
             # construct message
             for group_member in room:
-                breakout_message = breakout_message + "\n{}".format(group_member[0])
-            # send out message
-            recipients = list(map(lambda group_member: group_member[1], room))
-            send_email(recipients, "Econ 26 Breakout Group Assignment {}".format(str(date.today())), breakout_message)
+                breakout_message = breakout_message + "\n{}".format(group_member.name)
+            recipients = list(map(lambda group_member: group_member.email, room))
+            messages.append((recipients, "Econ 26 Breakout Group Assignment {}".format(str(date.today())), breakout_message))
+        # send out every message over a few shared sessions
+        with stage('send emails ' + section):
+            failures = send_emails(messages)
+        for recipient in sorted(failures):
+            print('Could not email ' + recipient + ': ' + str(failures[recipient]))
 
         print('Done sending emails.')
 
             
 
-def main(given_section=None):
+# reads new mail and merges it with the requests already cached
+# returns the roster along with the request index holding today's skips and switches
+def gather_requests(session, review=True):
+    with stage('load roster'):
+        students = get_course_roster()
+    with stage('request cache'):
+        index = get_request_cache(students)
+    with stage('read emails'):
+        skips, switches, checkpoint = read_emails(session.get(), review, index.queued(), session)
+    with stage('save requests'):
+        today = date.today().isoformat()
+        # journal only what isn't already cached, then stop rescanning that mail
+        save_request_cache(index.merge(skips, 'skip', today), index.merge(switches, 'switch', today))
+        save_sync_checkpoint(checkpoint)
+    return students, index
+
+# a seed makes both the call list order and the groups repeatable
+def build_section(students, skips, targets, section, should_email=None, seed=None):
+    with stage('call list ' + section):
+        call_list = apply_skips(list(students), skips, section)
+        call_list = apply_switches(call_list, targets, section)
+        # call list should now only be students who are valid cold call candidates
+        (random if seed is None else random.Random(seed)).shuffle(call_list)
+        # write out csv regardless of action
+        write_list(call_list, section)
+
+    with stage('breakout groups ' + section):
+        create_breakout_groups(call_list, students, section, should_email, seed)
+
+    print('The cold call list has been downloaded for section ' + section + '.')
+
+# stands in for stdout while sections are built together
+# a thread with a buffer of its own prints into it, anything else goes straight through
+class ThreadOutput:
+    def __init__(self, stream):
+        import threading
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        return getattr(self.local, 'buffer', self.stream).write(text)
+
+    def flush(self):
+        getattr(self.local, 'buffer', self.stream).flush()
+
+# builds every section at once but prints each section's messages together and in section order
+def build_sections(students, skips, targets, sections, should_email=None, seed=None):
+    import io
+    import sys
+    from concurrent.futures import ThreadPoolExecutor
+    if len(sections) == 1:
+        build_section(students, skips, targets, sections[0], should_email, seed)
+        return
+    output = ThreadOutput(sys.stdout)
+    buffers = [io.StringIO() for section in sections]
+
+    def build(i):
+        output.local.buffer = buffers[i]
+        try:
+            build_section(students, skips, targets, sections[i], should_email, seed)
+        finally:
+            del output.local.buffer
+
+    try:
+        with redirect_stdout(output), ThreadPoolExecutor(max_workers=len(sections)) as pool:
+            # list so that an error in any section is raised here
+            list(pool.map(build, range(len(sections))))
+    finally:
+        # whatever a failed section got through is still shown
+        for buffer in buffers:
+            output.stream.write(buffer.getvalue())
+
+# builds the call list and groups for every section from a single read of the inbox and roster
+# then moves all of the requests that were used in one go
+def run_sections(mail, students, index, sections, should_email=None, day=None, seed=None):
+    day = day or date.today().isoformat()
+    skips = index.latest('skip', day)
+    targets = students.switch_targets(index.latest('switch', day))
+    build_sections(students, skips, targets, sections, should_email, seed)
+
+    processed = list()
+    for section in sections:
+        processed += processed_uids(students, index, targets, section, day)
+    with stage('move processed emails'):
+        move_emails(mail, processed)
+
+def main(given_section=None, seed=None):
     # login to email
-    mail = initialize_imap()
-    skips, switches = read_emails(mail)
+    with ImapSession() as session:
+        students, index = gather_requests(session)
+        if given_section:
+            sections = [given_section]
+        else:
+            sections = prompt_sections(get_sections(students))
+        # ask once up front instead of once per section
+        should_email = prompt_email() if len(sections) > 1 else None
+        # the prompts can take a while so make sure the connection is still there
+        run_sections(session.get(), students, index, sections, should_email, seed=seed)
+
+# same result as main but waits on the network as little as possible
+# the roster and cache load and the section prompt happen while the inbox is being read
+# moving processed mail happens while the groups are being emailed
+async def async_main(given_section=None, seed=None):
+    with ImapSession() as session:
+        await run_async(session, given_section, seed)
+
+async def run_async(session, given_section=None, seed=None):
+    import asyncio
+    def connect_and_fetch():
+        mail = session.get()
+        with stage('read emails'):
+            return (mail,) + fetch_new_mail(mail)
+
+    def load_roster_and_cache():
+        with stage('load roster and request cache'):
+            students = get_course_roster()
+            return students, get_request_cache(students)
+
+    mail_task = asyncio.create_task(asyncio.to_thread(connect_and_fetch))
+    students, index = await asyncio.to_thread(load_roster_and_cache)
+    if given_section:
+        sections = [given_section]
+    else:
+        sections = await asyncio.to_thread(prompt_sections, get_sections(students))
+    should_email = None
+    if len(sections) > 1:
+        should_email = await asyncio.to_thread(prompt_email)
+
+    mail, skips, switches, unknowns, checkpoint = await mail_task
+    review_unknowns(mail, skips, switches, unknowns, uidvalidity=checkpoint[0], queued=index.queued(), session=session)
+    # reviewing can take a while so make sure the connection is still there
+    mail = session.get()
+    today = date.today().isoformat()
+    save_request_cache(index.merge(skips, 'skip', today), index.merge(switches, 'switch', today))
+    save_sync_checkpoint(checkpoint)
+    skips = index.latest('skip', today)
+
+    targets = students.switch_targets(index.latest('switch', today))
+    processed = list()
+    for section in sections:
+        processed += processed_uids(students, index, targets, section, today)
+
+    def move():
+        with stage('move processed emails'):
+            move_emails(mail, processed)
+
+    # each section sends its own groups over its own sessions
+    await asyncio.gather(asyncio.to_thread(move), asyncio.to_thread(build_sections, students, skips, targets, sections, should_email, seed))
+
+# non interactive version of main for every section or just the given ones
+# unknown mail is left queued for the next interactive run
+def batch_main(sections=None, should_email=False, seed=None):
+    with ImapSession() as session:
+        students, index = gather_requests(session, review=False)
+        if not sections:
+            sections = sorted(get_sections(students))
+        run_sections(session.get(), students, index, [section.lower() for section in sections], should_email, seed=seed)
+
+# rebuilds the call lists and group files from the roster and the requests already journaled
+# never touches the network so it works without a connection and starts quickly
+# groups are not emailed and mail that arrived since the last online run is left for the next one
+def offline_main(sections=None, seed=None):
+    with stage('load roster'):
+        students = get_course_roster()
+    with stage('request cache'):
+        index = get_request_cache(students)
+    today = date.today().isoformat()
+    skips = index.latest('skip', today)
+    if not sections:
+        sections = sorted(get_sections(students))
+    targets = students.switch_targets(index.latest('switch', today))
+    for section in sections:
+        build_section(students, skips, targets, section.lower(), False, seed)
+
+# prints a usage report from the ledger after catching it up with the journal, never connects
+# with a student email or net id it lists every request that student made instead
+def report_main(report='students', student=None):
     students = get_course_roster()
-    call_list = list.copy(students)
-    num_uses = get_use_data()
-    skip_cache, switch_cache = get_request_cache(num_uses, students, skips, switches)
-    skips = combine_cache(skips, skip_cache)
-    switches = combine_cache(switches, switch_cache)
-    section = given_section
-    both = False
-    if not section:
-        section, both = prompt_sections(get_sections(call_list))
-    call_list = apply_skips(call_list, skips, num_uses, section)
-    call_list = apply_switches(call_list, switches, num_uses, section)
-    # call list should now only be students who are valid cold call candidates
-    random.shuffle(call_list)
-    # write out csv regardless of action
-    write_list(call_list, section)
-
-    create_breakout_groups(call_list, students, section)
+    db = update_ledger(students)
+    try:
+        if student:
+            header, query = STUDENT_REPORT
+            rows = db.execute(query, (student.lower(), student.lower())).fetchall()
+        else:
+            header, query = LEDGER_REPORTS[report]
+            rows = db.execute(query).fetchall()
+    finally:
+        db.close()
+    if len(rows) == 0:
+        print('No skips or switches have been recorded' + (' for ' + student if student else ''))
+        return
+    print_table(header, rows)
 
-    print('The cold call list has been downloaded for section ' + section + '.')
-    save_request_cache(skips, switches)
-    move_processed_emails(mail, students, skips, switches, section)
-    return both
-    
+# keeps running and rebuilds every section's call list and groups as requests arrive
+# unknown mail is queued for the next interactive run
+# the same connection is kept for the whole run and remade if the server drops it
+def daemon_main(poll_interval=DAEMON_POLL_INTERVAL):
+    import imaplib
+    with ImapSession() as session:
+        day = None
+        print('Watching the inbox for requests. Press ctrl-c to stop.')
+        while True:
+            try:
+                mail = session.get()
+                new_skips, new_switches, checkpoint = read_emails(mail, review=False)
+                students = get_course_roster()
+                changed = day != date.today().isoformat()
+                if changed:
+                    # first pass or a new day so load the cache again which also counts the old days
+                    day = date.today().isoformat()
+                    index = get_request_cache(students)
+                elif index.update() > 0:
+                    # an interactive run journaled requests since the last pass, reviewed or read before us
+                    changed = True
+                new_skips = index.merge(new_skips, 'skip', day)
+                new_switches = index.merge(new_switches, 'switch', day)
+                save_request_cache(new_skips, new_switches)
+                save_sync_checkpoint(checkpoint)
+                if changed or len(new_skips) > 0 or len(new_switches) > 0:
+                    run_sections(mail, students, index, sorted(get_sections(students)), False, day)
+                    queued = len(index.unknowns)
+                    if queued > 0:
+                        print(str(queued) + ' emails are waiting to be classified on the next interactive run')
 
+                if 'IDLE' in mail.capabilities:
+                    idle(mail, IDLE_TIMEOUT)
+                else:
+                    time.sleep(poll_interval)
+            except (imaplib.IMAP4.abort, OSError) as e:
+                # anything not yet checkpointed is read again on the new connection
+                print('Lost the connection to the mail server (' + (str(e) or type(e).__name__) + '), reconnecting')
+                session.drop()
 
-if __name__ == '__main__':
-    # try:
-    section = None
-    while True:
+# reads a json course config with a list of courses, each with its own folder and account
+# folders are relative to the config file
+# {"workers": 4, "courses": [{"name": "econ26", "dir": "econ26", "email": "...", "password": "...",
+#   "imap_server": "imap.gmail.com", "smtp_server": "smtp.gmail.com", "smtp_port": 465,
+#   "sections": ["10a", "2"], "email_groups": false}]}
+def load_courses(path):
+    try:
+        with open(path) as f:
+            config = json.load(f)
+    except FileNotFoundError:
+        raise Exception('Could not find course config ' + path)
+    courses = config.get('courses', [])
+    if len(courses) == 0:
+        raise Exception('Course config ' + path + ' does not list any courses')
+    names = set()
+    for course in courses:
+        missing = [key for key in ('name', 'dir', 'email', 'password') if key not in course]
+        if len(missing) > 0:
+            raise Exception('Course ' + course.get('name', str(courses.index(course) + 1)) + ' in ' + path + ' is missing ' + ', '.join(missing))
+        if course['name'] in names:
+            raise Exception('Course ' + course['name'] + ' is listed more than once in ' + path)
+        names.add(course['name'])
+        course['dir'] = os.path.join(os.path.dirname(os.path.abspath(path)), course['dir'])
+    return config.get('workers', COURSE_WORKERS), courses
+
+# points the module at one course's folder and account
+# a pool process can run several courses so every setting is reset, missing ones to the defaults
+def configure_course(course):
+    global dir_path, FROM_EMAIL, FROM_PWD, SMTP_SERVER, SEND_EMAIL_SERVER, SEND_EMAIL_PORT
+    dir_path = course['dir']
+    FROM_EMAIL = course['email']
+    FROM_PWD = course['password']
+    SMTP_SERVER = course.get('imap_server', COURSE_DEFAULTS['imap_server'])
+    SEND_EMAIL_SERVER = course.get('smtp_server', COURSE_DEFAULTS['smtp_server'])
+    SEND_EMAIL_PORT = course.get('smtp_port', COURSE_DEFAULTS['smtp_port'])
+
+# worker process body, runs one course in batch mode and logs to its folder
+def run_course(course, should_email=False, profile=False):
+    import traceback
+    configure_course(course)
+    if profile:
+        start_profiling()
+    with open(dir_path + '/' + COURSE_LOG, 'w') as log, redirect_stdout(log):
         try:
-            section = main(section)
-            if not section:
-                input('Press enter to exit.')
-                exit()
-        except gaierror:
-            print('Cannot connect to internet. Please check your connection and try again.')
+            batch_main(course.get('sections'), course.get('email_groups', should_email))
+        except Exception:
+            traceback.print_exc(file=log)
+            raise
+        finally:
+            if profiler is not None:
+                profiler.save()
+    return course['name']
+
+# runs every course in the config at once, a failing course doesn't stop the others
+# returns the names of the courses that failed
+def courses_main(path, workers=None, should_email=False, profile=False):
+    from concurrent.futures import ProcessPoolExecutor, as_completed
+    config_workers, courses = load_courses(path)
+    workers = min(workers or config_workers, len(courses))
+    failed = list()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = { pool.submit(run_course, course, should_email, profile): course for course in courses }
+        for future in as_completed(futures):
+            course = futures[future]
+            try:
+                future.result()
+                print('Finished ' + course['name'] + ', output is in ' + os.path.join(course['dir'], COURSE_LOG))
+            except Exception as e:
+                print('Could not process ' + course['name'] + ': ' + (str(e) or type(e).__name__) + '. See ' + os.path.join(course['dir'], COURSE_LOG))
+                failed.append(course['name'])
+    return failed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate cold call lists and breakout groups')
+    parser.add_argument('--batch', action='store_true', help='generate every section without prompting')
+    parser.add_argument('--sections', nargs='+', help='sections to generate in batch or offline mode, defaults to all of them')
+    parser.add_argument('--email', action='store_true', help='email the breakout groups in batch mode')
+    parser.add_argument('--daemon', action='store_true', help='keep the call lists up to date as requests arrive')
+    parser.add_argument('--interval', type=int, default=DAEMON_POLL_INTERVAL, help='seconds between inbox checks when the server does not support idle')
+    parser.add_argument('--offline', action='store_true', help='rebuild the call lists and groups from the roster and cached requests without connecting')
+    parser.add_argument('--report', nargs='?', const='students', choices=sorted(LEDGER_REPORTS), help='print a usage report for the semester without connecting, defaults to students')
+    parser.add_argument('--student', help='with --report, list every request from the student with this email or net id')
+    parser.add_argument('--seed', type=int, help='seed for the call list order and breakout groups so a run can be repeated')
+    parser.add_argument('--async', dest='use_async', action='store_true', help='overlap reading mail, loading the roster, and sending groups')
+    parser.add_argument('--profile', action='store_true', help='write a timing and round trip report, same as setting ' + PROFILE_ENV + '=1')
+    parser.add_argument('--courses', help='json config of courses to generate in batch mode at the same time')
+    parser.add_argument('--workers', type=int, help='number of courses to process at once, defaults to the config or ' + str(COURSE_WORKERS))
+    args = parser.parse_args()
+    profile = args.profile or os.environ.get(PROFILE_ENV, '') not in ('', '0')
+    if profile and not args.courses:
+        start_profiling()
+    try:
+        if args.courses:
+            # each course profiles itself and writes its report to its own folder
+            if len(courses_main(args.courses, args.workers, args.email, profile)) > 0:
+                exit(1)
+        elif args.daemon:
+            daemon_main(args.interval)
+        elif args.report or args.student:
+            report_main(args.report or 'students', args.student)
+        elif args.offline:
+            offline_main(args.sections, args.seed)
+        elif args.batch:
+            batch_main(args.sections, args.email, args.seed)
+        elif args.use_async:
+            import asyncio
+            asyncio.run(async_main(seed=args.seed))
             input('Press enter to exit.')
-            exit()
-    # except Exception as e:
-    #     print(e)
-    #     input('Press enter to exit.')
\ No newline at end of file
+        else:
+            main(seed=args.seed)
+            input('Press enter to exit.')
+    except OSError as e:
+        # socket is always loaded by the time anything could fail to resolve
+        from socket import gaierror
+        if not isinstance(e, gaierror):
+            raise
+        print('Cannot connect to internet. Please check your connection and try again.')
+        if not args.batch and not args.daemon and not args.courses:
+            input('Press enter to exit.')
+    except KeyboardInterrupt:
+        print()
+    finally:
+        if profiler is not None:
+            profiler.save()
+    exit()
@@ -0,0 +1,356 @@
+# offline benchmarks for autocall
+# runs the real code against in process imap and smtp stand ins with synthetic rosters and inboxes
+# usage: python benchmark.py --sizes 50 500 5000 --latency 20
+
+import argparse
+import bisect
+import contextlib
+import csv
+import imaplib
+import os
+import random
+import re
+import select
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+import tracemalloc
+
+import autocall
+
+DEFAULT_SIZES = [50, 500, 5000, 50000]
+
+# mailbox shared by every connection to the fake imap server
+class FakeMailbox:
+    def __init__(self, uidvalidity=1):
+        self.lock = threading.Lock()
+        self.uidvalidity = uidvalidity
+        self.folders = { 'INBOX': list(), 'processed': list() }
+        self.uidnext = { 'INBOX': 1, 'processed': 1 }
+
+    def add(self, raw, folder='INBOX'):
+        with self.lock:
+            uid = self.uidnext[folder]
+            self.uidnext[folder] += 1
+            self.folders[folder].append({ 'uid': uid, 'flags': set(), 'raw': raw })
+            return uid
+
+    # returns the messages in the folder whose uids are in an imap sequence set such as 1:5,9,12:*
+    def matching(self, folder, uid_set):
+        messages = self.folders[folder]
+        uids = [message['uid'] for message in messages]
+        newest = uids[-1] if len(uids) > 0 else 0
+        found = dict()
+        for part in uid_set.split(','):
+            low, _, high = part.partition(':')
+            low = newest if low == '*' else int(low)
+            high = low if high == '' else newest if high == '*' else int(high)
+            # uids only ever grow so the folder is sorted by uid
+            start = bisect.bisect_left(uids, min(low, high))
+            end = bisect.bisect_right(uids, max(low, high))
+            for i in range(start, end):
+                found[i] = messages[i]
+        return [found[i] for i in sorted(found)]
+
+# speaks enough imap4rev1 for autocall, sleeping for the configured latency on every command
+class FakeImapHandler(socketserver.StreamRequestHandler):
+    disable_nagle_algorithm = True
+
+    def write(self, data):
+        self.wfile.write(data if isinstance(data, bytes) else data.encode())
+
+    def handle(self):
+        server = self.server
+        box = server.mailbox
+        selected = None
+        # like gmail the extensions are only listed once logged in
+        logged_in = False
+        self.write('* OK [CAPABILITY IMAP4rev1] fake imap ready\r\n')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            server.count(len(line))
+            tag, _, rest = line.decode().rstrip('\r\n').partition(' ')
+            command, _, args = rest.partition(' ')
+            command = command.upper()
+            if command == 'UID':
+                sub_command, _, args = args.partition(' ')
+                command = 'UID ' + sub_command.upper()
+            if server.latency:
+                time.sleep(server.latency)
+
+            if command == 'CAPABILITY':
+                self.write('* CAPABILITY ' + ' '.join(('IMAP4rev1',) + (tuple(server.capabilities) if logged_in else ())) + '\r\n')
+            elif command == 'LOGIN':
+                logged_in = True
+            elif command in ('SELECT', 'EXAMINE'):
+                selected = args.strip('"')
+                if selected.upper() == 'INBOX':
+                    selected = 'INBOX'
+                with box.lock:
+                    self.write('* %d EXISTS\r\n' % len(box.folders[selected]))
+                    self.write('* OK [UIDVALIDITY %d] ok\r\n' % box.uidvalidity)
+                    self.write('* OK [UIDNEXT %d] ok\r\n' % box.uidnext[selected])
+            elif command == 'LOGOUT':
+                self.write('* BYE\r\n' + tag + ' OK done\r\n')
+                return
+            elif command in ('EXPUNGE', 'CLOSE'):
+                with box.lock:
+                    box.folders[selected] = [message for message in box.folders[selected] if '\\Deleted' not in message['flags']]
+            elif command == 'IDLE':
+                self.idle(box, selected)
+            elif command == 'UID SEARCH':
+                match = re.search(r'UID (\S+)', args)
+                with box.lock:
+                    found = box.matching(selected, match.group(1)) if match else box.folders[selected]
+                    self.write('* SEARCH ' + ' '.join(str(message['uid']) for message in found) + '\r\n')
+            elif command == 'UID FETCH':
+                uid_set, _, items = args.partition(' ')
+                with box.lock:
+                    found = box.matching(selected, uid_set)
+                response = list()
+                for seq, message in enumerate(found, 1):
+                    name, payload = self.fetch_item(message['raw'], items)
+                    response.append(b'* %d FETCH (UID %d %s {%d}\r\n' % (seq, message['uid'], name.encode(), len(payload)) + payload + b')\r\n')
+                self.write(b''.join(response))
+            elif command == 'UID STORE':
+                uid_set, _, _ = args.partition(' ')
+                with box.lock:
+                    for message in box.matching(selected, uid_set):
+                        message['flags'].add('\\Deleted')
+            elif command in ('UID COPY', 'UID MOVE'):
+                uid_set, _, folder = args.partition(' ')
+                folder = folder.strip('"')
+                with box.lock:
+                    found = box.matching(selected, uid_set)
+                    for message in found:
+                        box.folders[folder].append({ 'uid': box.uidnext[folder], 'flags': set(), 'raw': message['raw'] })
+                        box.uidnext[folder] += 1
+                    if command == 'UID MOVE':
+                        moved = set(id(message) for message in found)
+                        box.folders[selected] = [message for message in box.folders[selected] if id(message) not in moved]
+            elif command not in ('LOGIN', 'NOOP'):
+                self.write(tag + ' BAD unsupported command\r\n')
+                continue
+            self.write(tag + ' OK done\r\n')
+
+    def fetch_item(self, raw, items):
+        head, _, body = raw.partition(b'\r\n\r\n')
+        fields = re.search(r'HEADER\.FIELDS \(([^)]*)\)', items)
+        if fields:
+            wanted = fields.group(1).lower().split()
+            kept = [header for header in re.split(rb'\r\n(?![ \t])', head) if header.split(b':')[0].decode().lower() in wanted]
+            return 'BODY[HEADER.FIELDS (' + fields.group(1).upper() + ')]', b'\r\n'.join(kept) + b'\r\n\r\n'
+        if 'TEXT' in items:
+            partial = re.search(r'<(\d+)\.(\d+)>', items)
+            if partial:
+                start = int(partial.group(1))
+                return 'BODY[TEXT]<' + partial.group(1) + '>', body[start:start + int(partial.group(2))]
+            return 'BODY[TEXT]', body
+        return 'RFC822' if 'RFC822' in items else 'BODY[]', raw
+
+    # reports new mail until the client sends DONE
+    def idle(self, box, selected):
+        self.write('+ idling\r\n')
+        with box.lock:
+            count = len(box.folders[selected])
+        while True:
+            if select.select([self.connection], [], [], 0.05)[0]:
+                line = self.rfile.readline()
+                if not line or line.strip().upper() == b'DONE':
+                    return
+            with box.lock:
+                if len(box.folders[selected]) != count:
+                    count = len(box.folders[selected])
+                    self.write('* %d EXISTS\r\n' % count)
+
+# speaks enough esmtp for smtplib, sleeping for the configured latency on every command
+class FakeSmtpHandler(socketserver.StreamRequestHandler):
+    disable_nagle_algorithm = True
+
+    def handle(self):
+        server = self.server
+        self.wfile.write(b'220 fake smtp ready\r\n')
+        recipients = list()
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            server.count(len(line))
+            verb = line.decode().strip().split(' ')[0].upper()
+            if server.latency:
+                time.sleep(server.latency)
+            if verb in ('EHLO', 'HELO'):
+                self.wfile.write(b'250-fake\r\n250 AUTH PLAIN LOGIN\r\n')
+            elif verb == 'AUTH':
+                self.wfile.write(b'235 accepted\r\n')
+            elif verb == 'RCPT':
+                recipients.append(line.decode())
+                self.wfile.write(b'250 ok\r\n')
+            elif verb == 'DATA':
+                self.wfile.write(b'354 go ahead\r\n')
+                # the message body isn't a round trip so read it straight through
+                for data in self.rfile:
+                    server.count(len(data))
+                    if data == b'.\r\n':
+                        break
+                with server.lock:
+                    server.delivered += 1
+                recipients = list()
+                self.wfile.write(b'250 queued\r\n')
+            elif verb == 'QUIT':
+                self.wfile.write(b'221 bye\r\n')
+                return
+            else:
+                self.wfile.write(b'250 ok\r\n')
+
+class FakeServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, handler, latency=0.0):
+        super().__init__(('127.0.0.1', 0), handler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.commands = 0
+        self.bytes_received = 0
+        self.delivered = 0
+
+    def count(self, size):
+        with self.lock:
+            self.commands += 1
+            self.bytes_received += size
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+def fake_imap_server(mailbox, latency=0.0, capabilities=('MOVE', 'IDLE')):
+    server = FakeServer(FakeImapHandler, latency)
+    server.mailbox = mailbox
+    server.capabilities = capabilities
+    return server.start()
+
+def fake_smtp_server(latency=0.0):
+    return FakeServer(FakeSmtpHandler, latency).start()
+
+# writes a roster.csv with the given number of students spread across the sections
+def make_roster(path, size, sections, rng):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(autocall.ROSTER_FIELDS)
+        for i in range(size):
+            used = rng.random() < 0.3
+            writer.writerow((
+                'Student ' + str(i),
+                'student' + str(i) + '@dartmouth.edu',
+                sections[i % len(sections)],
+                'd' + str(100000 + i),
+                rng.randint(1, 12),
+                rng.randint(0, 5) if used else '',
+                rng.randint(0, 3) if used else ''
+            ))
+
+def make_message(sender, subject, body='Sent from my phone'):
+    return ('From: ' + sender + '\r\nTo: course@gmail.com\r\nSubject: ' + subject + '\r\n\r\n' + body + '\r\n').encode()
+
+# fills the inbox with a mix of skips, switches, spam, and mail that needs a person to classify
+def make_inbox(mailbox, size, roster_size, sections, rng):
+    for _ in range(size):
+        student = 'student' + str(rng.randrange(roster_size)) + '@dartmouth.edu'
+        kind = rng.random()
+        if kind < 0.45:
+            mailbox.add(make_message('Student <' + student + '>', 'skip'))
+        elif kind < 0.75:
+            target = '' if len(sections) == 2 else ' ' + rng.choice(sections)
+            mailbox.add(make_message('Student <' + student + '>', 'Switch' + target))
+        elif kind < 0.9:
+            mailbox.add(make_message('deals@example.com', 'You have won'))
+        else:
+            mailbox.add(make_message('Student <' + student + '>', 'question about the reading'))
+
+# runs one stage and returns its row for the report along with whatever the stage returned
+def measure(stage, size, run, servers, trace_memory):
+    before = [(server.commands, server.bytes_received) for server in servers]
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        result = run()
+    elapsed = time.perf_counter() - start
+    peak = 0
+    if trace_memory:
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    round_trips = sum(server.commands - commands for server, (commands, _) in zip(servers, before))
+    sent = sum(server.bytes_received - received for server, (_, received) in zip(servers, before))
+    return { 'stage': stage, 'size': size, 'seconds': elapsed, 'round_trips': round_trips, 'bytes_sent': sent, 'peak_kib': peak / 1024 }, result
+
+def bench_size(size, latency, section_count, seed, trace_memory):
+    rng = random.Random(seed)
+    sections = ['s' + str(i + 1) for i in range(section_count)]
+    workdir = tempfile.mkdtemp(prefix='autocall-bench-')
+    autocall.dir_path = workdir
+    try:
+        make_roster(workdir + '/roster.csv', size, sections, rng)
+        mailbox = FakeMailbox()
+        make_inbox(mailbox, size, size, sections, rng)
+        imap = fake_imap_server(mailbox, latency)
+        smtp = fake_smtp_server(latency)
+        autocall.SEND_EMAIL_SERVER, autocall.SEND_EMAIL_PORT = smtp.server_address
+        autocall.SEND_EMAIL_SSL = False
+
+        mail = imaplib.IMAP4(*imap.server_address)
+        autocall.login_imap(mail)
+        rows = list()
+
+        row, (skips, switches, _) = measure('read_emails', size, lambda: autocall.read_emails(mail, review=False), [imap], trace_memory)
+        rows.append(row)
+        students = autocall.get_course_roster()
+
+        def apply_requests():
+            targets = students.switch_targets(switches)
+            return { section: autocall.apply_switches(autocall.apply_skips(list(students), skips, section), targets, section) for section in sections }
+        row, call_lists = measure('apply_skips/apply_switches', size, apply_requests, [], trace_memory)
+        rows.append(row)
+
+        def create_groups():
+            for section in sections:
+                autocall.create_breakout_groups(call_lists[section], students, section, True, seed)
+        row, _ = measure('create_breakout_groups', size, create_groups, [smtp], trace_memory)
+        rows.append(row)
+
+        def save_uses():
+            autocall.count_uses(students, skips, switches)
+            autocall.save_uses_to_csv(students)
+        row, _ = measure('save_uses_to_csv', size, save_uses, [], trace_memory)
+        rows.append(row)
+
+        mail.logout()
+        imap.shutdown()
+        smtp.shutdown()
+        return rows
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+def print_report(rows):
+    print('%-28s %8s %10s %12s %12s %12s' % ('stage', 'size', 'seconds', 'round trips', 'bytes sent', 'peak KiB'))
+    for row in rows:
+        print('%-28s %8d %10.3f %12d %12d %12.0f' % (row['stage'], row['size'], row['seconds'], row['round_trips'], row['bytes_sent'], row['peak_kib']))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark autocall against local imap and smtp stand ins')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES, help='number of students and of inbox messages to generate')
+    parser.add_argument('--latency', type=float, default=0.0, help='milliseconds the fake servers wait before answering each command')
+    parser.add_argument('--sections', type=int, default=2, help='number of sections in the synthetic roster')
+    parser.add_argument('--seed', type=int, default=26)
+    parser.add_argument('--no-memory', action='store_true', help='skip peak memory tracing, which slows every stage down')
+    args = parser.parse_args()
+
+    rows = list()
+    for size in args.sizes:
+        rows += bench_size(size, args.latency / 1000, args.sections, args.seed, not args.no_memory)
+    print_report(rows)